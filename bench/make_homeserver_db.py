@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Generates a synthetic homeserver.db with the tables and indexes
+that synapse-tools reads, for benchmarks'''
+
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+# The parts of Synapse's sqlite schema that synapse-tools uses
+SCHEMA = '''
+CREATE TABLE events(stream_ordering INTEGER PRIMARY KEY, topological_ordering BIGINT NOT NULL,
+  event_id TEXT NOT NULL, type TEXT NOT NULL, room_id TEXT NOT NULL, content TEXT,
+  unrecognized_keys TEXT, processed BOOL NOT NULL, outlier BOOL NOT NULL, depth BIGINT DEFAULT 0 NOT NULL,
+  origin_server_ts BIGINT, received_ts BIGINT, sender TEXT, contains_url BOOLEAN, instance_name TEXT,
+  state_key TEXT DEFAULT NULL, rejection_reason TEXT DEFAULT NULL, UNIQUE (event_id));
+CREATE TABLE rooms(room_id TEXT PRIMARY KEY NOT NULL, is_public BOOL, creator TEXT,
+  room_version TEXT, has_auth_chain_index BOOLEAN);
+CREATE TABLE access_tokens(id BIGINT PRIMARY KEY, user_id TEXT NOT NULL, device_id TEXT,
+  token TEXT NOT NULL, valid_until_ms BIGINT, puppets_user_id TEXT, last_validated BIGINT,
+  refresh_token_id BIGINT, used BOOLEAN, UNIQUE(token));
+CREATE TABLE redactions(event_id TEXT NOT NULL, redacts TEXT NOT NULL,
+  have_censored BOOL NOT NULL DEFAULT false, received_ts BIGINT, UNIQUE (event_id));
+CREATE TABLE local_media_repository (media_id TEXT, media_type TEXT, media_length INTEGER,
+  created_ts BIGINT, upload_name TEXT, user_id TEXT, quarantined_by TEXT, url_cache TEXT,
+  last_access_ts BIGINT, safe_from_quarantine BOOLEAN NOT NULL DEFAULT 0, UNIQUE (media_id));
+'''
+
+INDEXES = '''
+CREATE INDEX events_order_room ON events (room_id, topological_ordering, stream_ordering);
+CREATE INDEX events_room_stream ON events (room_id, stream_ordering);
+CREATE INDEX events_ts ON events (origin_server_ts, stream_ordering);
+CREATE INDEX events_jump_to_date_idx ON events (room_id, origin_server_ts) WHERE NOT outlier;
+CREATE INDEX access_tokens_device_id ON access_tokens (user_id, device_id);
+CREATE INDEX redactions_redacts ON redactions (redacts);
+'''
+
+
+def room_id(n, server_name):
+  '''Returns the id of the nth synthetic room'''
+  return '!room' + str(n) + ':' + server_name
+
+
+def user_id(n, server_name):
+  '''Returns the id of the nth synthetic user'''
+  return '@user' + str(n) + ':' + server_name
+
+
+def generate(path, rooms, events, users, days, redacted, server_name, media=0, seed=0):
+  '''Writes a homeserver.db with rooms, users with an access token each, and
+  events and media spread over the last days, a fraction of the events already redacted'''
+  if os.path.exists(path):
+    os.remove(path)
+  random.seed(seed)
+  conn = sqlite3.connect(path)
+  conn.execute('PRAGMA journal_mode = OFF;')
+  conn.execute('PRAGMA synchronous = OFF;')
+  conn.executescript(SCHEMA)
+  conn.executemany('INSERT INTO rooms (room_id, is_public, creator, room_version, has_auth_chain_index) \
+                   VALUES (?, 0, ?, \'10\', 1);',
+                   ((room_id(n, server_name), user_id(n % users, server_name)) for n in range(rooms)))
+  conn.executemany('INSERT INTO access_tokens (id, user_id, device_id, token) VALUES (?, ?, ?, ?);',
+                   ((n, user_id(n, server_name), 'DEVICE' + str(n), 'token' + str(n)) for n in range(users)))
+  now = int(time.time() * 1000)
+  start = now - days * 86400000
+  step = (now - start) / max(events, 1)
+  types = ['m.room.message'] * 7 + ['m.room.encrypted'] * 2 + ['m.room.member']
+  batch = []
+  for n in range(events):
+    # Events arrive in time order, so stream_ordering follows origin_server_ts
+    event_id = '$event' + str(n)
+    room = room_id(random.randrange(rooms), server_name)
+    sender = user_id(random.randrange(users), server_name)
+    batch.append((n + 1, n + 1, event_id, random.choice(types), room, int(start + n * step), sender))
+    if len(batch) == 10000:
+      insert_events(conn, batch, redacted)
+      batch = []
+  insert_events(conn, batch, redacted)
+  # Media is last accessed some time after it is uploaded, up to a day later
+  uploads = (int(start + random.random() * (now - start)) for n in range(media))
+  conn.executemany('INSERT INTO local_media_repository (media_id, media_type, media_length, created_ts, \
+                   upload_name, user_id, last_access_ts) VALUES (?, \'image/png\', ?, ?, ?, ?, ?);',
+                   (('media' + str(n), random.randint(1024, 10485760), ts, 'upload' + str(n) + '.png',
+                     user_id(n % users, server_name), ts + random.randint(0, 86400000))
+                    for n, ts in enumerate(uploads)))
+  conn.executescript(INDEXES)
+  conn.execute('ANALYZE;')
+  conn.commit()
+  conn.close()
+
+
+def insert_events(conn, batch, redacted):
+  '''Inserts a batch of events and redacts a fraction of them'''
+  conn.executemany('INSERT INTO events (stream_ordering, topological_ordering, event_id, type, room_id, \
+                   processed, outlier, origin_server_ts, received_ts, sender) \
+                   VALUES (?, ?, ?, ?, ?, 1, 0, ?, ?, ?);',
+                   ((row[0], row[1], row[2], row[3], row[4], row[5], row[5], row[6]) for row in batch))
+  conn.executemany('INSERT INTO redactions (event_id, redacts, have_censored, received_ts) VALUES (?, ?, 0, ?);',
+                   (('$redaction' + row[2][1:], row[2], row[5]) for row in batch if random.random() < redacted))
+
+
+def main():
+  '''Generates a synthetic homeserver.db from the command line'''
+  parser = argparse.ArgumentParser(description='Synthetic homeserver.db for benchmarks.')
+  parser.add_argument('path', help='database to write, replaced if it exists')
+  parser.add_argument('--rooms', help='number of rooms', type=int, default=10000)
+  parser.add_argument('--events', help='number of events', type=int, default=1000000)
+  parser.add_argument('--users', help='number of users', type=int, default=1000)
+  parser.add_argument('--media', help='number of uploaded media files', type=int, default=10000)
+  parser.add_argument('--days', help='days of history the events are spread over', type=float, default=30)
+  parser.add_argument('--redacted', help='fraction of events already redacted', type=float, default=0.01)
+  parser.add_argument('--server-name', help='server_name of the rooms and users', default='bench.local')
+  args = parser.parse_args()
+  started = time.monotonic()
+  generate(args.path, args.rooms, args.events, args.users, args.days, args.redacted, args.server_name, args.media)
+  print('Generated ' + args.path + ' in ' + str(round(time.monotonic() - started, 1)) + 's')
+
+
+if __name__ == '__main__':
+  main()
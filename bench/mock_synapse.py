@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Local stand-in for the Synapse endpoints that synapse-tools calls, with
+configurable latency and rate limiting, for benchmarks'''
+
+import argparse
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Shared by all handler threads, always holding lock
+state = {
+  'rooms': [],
+  'users': [],
+  'jobs': {},
+  'latency': 0.0,
+  'rate_limit': 0.0,
+  'retry_after_ms': 50,
+  'job_seconds': 0.0,
+  'requests': {},
+  # homeserver.db that media deletions are applied to, if any
+  'database': None,
+}
+lock = threading.Lock()
+
+
+def load_rooms(rooms, server_name, abandoned=0.1, seed=0):
+  '''Makes the rooms listed by the mock, a fraction of them without members'''
+  random.seed(seed)
+  state['rooms'] = []
+  for n in range(rooms):
+    members = 0
+    if random.random() >= abandoned:
+      members = random.randint(1, 50)
+    state['rooms'].append({
+      'room_id': '!room' + str(n) + ':' + server_name,
+      'name': 'Room ' + str(n),
+      'canonical_alias': '#room' + str(n) + ':' + server_name,
+      'joined_members': members,
+      'joined_local_members': members,
+      'version': '10',
+      'creator': '@user0:' + server_name,
+      'encryption': None,
+      'federatable': True,
+      'public': False,
+      'join_rules': 'invite',
+      'guest_access': None,
+      'history_visibility': 'shared',
+      'state_events': 10 + members,
+      'room_type': None,
+    })
+
+
+def load_users(users, server_name):
+  '''Makes the users listed by the mock'''
+  now = int(time.time() * 1000)
+  state['users'] = []
+  for n in range(users):
+    state['users'].append({
+      'name': '@user' + str(n) + ':' + server_name,
+      'user_type': None,
+      'is_guest': False,
+      'admin': n == 0,
+      'deactivated': False,
+      'shadow_banned': False,
+      'displayname': 'User ' + str(n),
+      'avatar_url': None,
+      'creation_ts': now - n * 1000,
+      'last_seen_ts': now - n * 60000,
+    })
+
+
+def start_job(kind):
+  '''Registers a server-side job that completes after job_seconds'''
+  job_id = kind + str(len(state['jobs']))
+  state['jobs'][job_id] = time.monotonic() + state['job_seconds']
+  return job_id
+
+
+def job_status(job_id, done):
+  '''Returns done once a job has run for job_seconds, or None if it is unknown'''
+  if job_id not in state['jobs']:
+    return None
+  if time.monotonic() >= state['jobs'][job_id]:
+    return done
+  return 'active'
+
+
+def list_rooms(query):
+  '''Pages through rooms like /_synapse/admin/v1/rooms'''
+  rooms = state['rooms']
+  order_by = query.get('order_by', ['name'])[0]
+  if order_by in ('joined_members', 'joined_local_members'):
+    rooms = sorted(rooms, key=lambda room: room[order_by], reverse=True)
+  if query.get('dir', ['f'])[0] == 'b':
+    rooms = list(reversed(rooms))
+  start = int(query.get('from', ['0'])[0])
+  limit = int(query.get('limit', ['100'])[0])
+  page = {'rooms': rooms[start:start + limit], 'offset': start, 'total_rooms': len(rooms)}
+  if start + limit < len(rooms):
+    page['next_batch'] = start + limit
+  return 200, page
+
+
+def list_users(query):
+  '''Pages through users like /_synapse/admin/v2/users'''
+  start = int(query.get('from', ['0'])[0])
+  limit = int(query.get('limit', ['100'])[0])
+  page = {'users': state['users'][start:start + limit], 'total': len(state['users'])}
+  if start + limit < len(state['users']):
+    page['next_token'] = str(start + limit)
+  return 200, page
+
+
+def user_devices(user_id):
+  '''Returns a user's devices, between one and four of them, seen up to 180 days ago'''
+  now = int(time.time() * 1000)
+  seed = sum(user_id.encode('utf-8'))
+  devices = []
+  for n in range(seed % 4 + 1):
+    devices.append({'device_id': 'DEVICE' + str(n), 'display_name': 'Device ' + str(n), 'user_id': user_id,
+                    'last_seen_ip': '127.0.0.1', 'last_seen_ts': now - (seed * (n + 1)) % 180 * 86400000})
+  return devices
+
+
+def whois(user_id):
+  '''Returns a user's sessions like /_synapse/admin/v1/whois'''
+  devices = {}
+  for device in user_devices(user_id):
+    connection = {'ip': device['last_seen_ip'], 'last_seen': device['last_seen_ts'], 'user_agent': 'bench'}
+    devices[device['device_id']] = {'sessions': [{'connections': [connection]}]}
+  return 200, {'user_id': user_id, 'devices': devices}
+
+
+def room_state(room_id):
+  '''Returns a room's state with its create event a day old'''
+  created = int(time.time() * 1000) - 86400000
+  return 200, {'state': [{'type': 'm.room.create', 'room_id': room_id, 'origin_server_ts': created}]}
+
+
+def status_of(job_id, done, extra={}):
+  '''Answers a job status request'''
+  status = job_status(job_id, done)
+  if status == None:
+    return 404, {'errcode': 'M_NOT_FOUND'}
+  response = {'status': status}
+  response.update(extra)
+  return 200, response
+
+
+def delete_media(query):
+  '''Deletes local media like /_synapse/admin/v1/media/<server_name>/delete'''
+  if state['database'] == None:
+    return 200, {'deleted_media': [], 'total': 0}
+  before_ts = int(query['before_ts'][0])
+  size_gt = int(query.get('size_gt', ['0'])[0])
+  conn = sqlite3.connect(state['database'])
+  sql = 'FROM local_media_repository WHERE created_ts < ? AND media_length > ? \
+        AND (last_access_ts IS NULL OR last_access_ts < ?) AND quarantined_by IS NULL AND NOT safe_from_quarantine'
+  params = (before_ts, size_gt, before_ts)
+  deleted = [row[0] for row in conn.execute('SELECT media_id ' + sql, params)]
+  conn.execute('DELETE ' + sql, params)
+  conn.commit()
+  conn.close()
+  return 200, {'deleted_media': deleted, 'total': len(deleted)}
+
+
+# (method, path pattern, handler(match, query)) in the order they are tried
+ROUTES = [
+  ('POST', r'/_matrix/client/r0/login', lambda m, q: (200, {'access_token': 'benchtoken', 'device_id': 'BENCH'})),
+  ('POST', r'/_matrix/client/r0/logout(/all)?', lambda m, q: (200, {})),
+  ('GET', r'/_matrix/client/r0/account/whoami',
+   lambda m, q: (200, {'user_id': '@admin:bench.local', 'device_id': 'BENCH'})),
+  ('GET', r'/_synapse/admin/v1/rooms', lambda m, q: list_rooms(q)),
+  ('GET', r'/_synapse/admin/v1/rooms/([^/]+)/state', lambda m, q: room_state(m.group(1))),
+  ('POST', r'/_matrix/client/api/v1/rooms/([^/]+)/redact/([^/]+)', lambda m, q: (200, {'event_id': '$redaction'})),
+  ('POST', r'/_synapse/admin/v1/purge_history/([^/]+)', lambda m, q: (200, {'purge_id': start_job('purge')})),
+  ('GET', r'/_synapse/admin/v1/purge_history_status/([^/]+)', lambda m, q: status_of(m.group(1), 'complete')),
+  ('DELETE', r'/_synapse/admin/v2/rooms/([^/]+)', lambda m, q: (200, {'delete_id': start_job('delete')})),
+  ('GET', r'/_synapse/admin/v2/rooms/delete_status/([^/]+)', lambda m, q: status_of(m.group(1), 'complete')),
+  ('POST', r'/_synapse/admin/v1/user/([^/]+)/redact', lambda m, q: (200, {'redact_id': start_job('redact')})),
+  ('GET', r'/_synapse/admin/v1/user/redact_status/([^/]+)',
+   lambda m, q: status_of(m.group(1), 'completed', {'failed_redactions': {}})),
+  ('GET', r'/_synapse/admin/v2/users', lambda m, q: list_users(q)),
+  ('GET', r'/_synapse/admin/v2/users/([^/]+)', lambda m, q: (200, {'name': m.group(1), 'user_type': None, 'threepids': []})),
+  ('GET', r'/_synapse/admin/v2/users/([^/]+)/devices',
+   lambda m, q: (200, {'devices': user_devices(m.group(1)), 'total': len(user_devices(m.group(1)))})),
+  ('POST', r'/_synapse/admin/v2/users/([^/]+)/delete_devices', lambda m, q: (200, {})),
+  ('GET', r'/_synapse/admin/v1/whois/([^/]+)', lambda m, q: whois(m.group(1))),
+  ('PUT', r'/_synapse/admin/v2/users/([^/]+)', lambda m, q: (200, {'name': m.group(1)})),
+  ('POST', r'/_synapse/admin/v1/deactivate/([^/]+)', lambda m, q: (200, {'id_server_unbind_result': 'success'})),
+  ('POST', r'/_synapse/admin/v1/media/([^/]+)/delete', lambda m, q: delete_media(q)),
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+  '''Routes requests to the mock endpoints'''
+  # Keep-alive, like Synapse behind a reverse proxy
+  protocol_version = 'HTTP/1.1'
+  # Headers and body go out in separate writes, which Nagle would hold back
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    '''Keeps the benchmark output quiet'''
+    pass
+
+  def respond(self, method):
+    '''Answers a request after the configured latency'''
+    length = int(self.headers.get('Content-Length', 0))
+    if length > 0:
+      self.rfile.read(length)
+    url = urlparse(self.path)
+    path = unquote(url.path)
+    query = parse_qs(url.query)
+    time.sleep(state['latency'])
+    code, body = 404, {'errcode': 'M_UNRECOGNIZED'}
+    for route_method, pattern, handler in ROUTES:
+      match = re.fullmatch(pattern, path)
+      if route_method == method and match != None:
+        with lock:
+          endpoint = method + ' ' + pattern
+          state['requests'][endpoint] = state['requests'].get(endpoint, 0) + 1
+          # Synapse rate limits the client API, not the admin API
+          if '/_matrix/client/api/' in path and random.random() < state['rate_limit']:
+            code, body = 429, {'errcode': 'M_LIMIT_EXCEEDED', 'retry_after_ms': state['retry_after_ms']}
+          else:
+            code, body = handler(match, query)
+        break
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    self.respond('GET')
+
+  def do_POST(self):
+    self.respond('POST')
+
+  def do_PUT(self):
+    self.respond('PUT')
+
+  def do_DELETE(self):
+    self.respond('DELETE')
+
+
+def serve(port=0, latency=0.0, rate_limit=0.0, job_seconds=0.0):
+  '''Starts the mock on a background thread and returns the server'''
+  state['latency'] = latency
+  state['rate_limit'] = rate_limit
+  state['job_seconds'] = job_seconds
+  server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
+
+
+def main():
+  '''Runs the mock from the command line until interrupted'''
+  parser = argparse.ArgumentParser(description='Mock Synapse admin API for benchmarks.')
+  parser.add_argument('--port', help='port to listen on', type=int, default=8008)
+  parser.add_argument('--rooms', help='number of rooms', type=int, default=10000)
+  parser.add_argument('--users', help='number of users', type=int, default=1000)
+  parser.add_argument('--latency', help='seconds added to every response', type=float, default=0.0)
+  parser.add_argument('--rate-limit', help='fraction of client API requests answered with 429', type=float, default=0.0)
+  parser.add_argument('--job-seconds', help='seconds purges, deletions and redaction jobs take', type=float, default=0.0)
+  parser.add_argument('--server-name', help='server_name of the rooms and users', default='bench.local')
+  args = parser.parse_args()
+  load_rooms(args.rooms, args.server_name)
+  load_users(args.users, args.server_name)
+  server = serve(args.port, args.latency, args.rate_limit, args.job_seconds)
+  print('Mock Synapse on http://127.0.0.1:' + str(server.server_address[1]))
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+
+if __name__ == '__main__':
+  main()
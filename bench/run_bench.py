@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Runs synapse-tools against a synthetic homeserver.db and a mock Synapse,
+reporting wall time, throughput, requests sent and peak memory'''
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH)
+
+import make_homeserver_db
+import mock_synapse
+from synapse_tools import core
+from synapse_tools import metrics as synapse_metrics
+from synapse_tools import retention as retention_command
+from synapse_tools import users
+
+# Phases of the last retention run, from its metrics_json
+phases = {}
+
+
+def write_config(path, baseurl, database, hours, args):
+  '''Writes the config.json the scripts read, with polling shortened to match the mock'''
+  s = {
+    'server_name': args.server_name,
+    'public_baseurl': baseurl,
+    'admin': 'admin',
+    'password': 'bench',
+    'database': database,
+    'rp_hours': hours,
+    'concurrency': args.concurrency,
+    'state': 'state.db',
+    'purge_concurrency': args.purge_concurrency,
+    'pool_size': args.concurrency * 2 + 2,
+    'connect_timeout': 5,
+    'read_timeout': 60,
+    'retries': 3,
+    'poll_interval': args.poll_interval,
+    'token_cache': '',
+    'redaction': args.redaction,
+    'index': 'index.db',
+    'metrics_textfile': '',
+    'metrics_json': 'metrics.json',
+    'media_retention': True,
+  }
+  with open(os.path.join(path, 'config.json'), 'w', encoding='utf-8') as config:
+    json.dump(s, config, indent=4)
+  return s
+
+
+def measure(name, run, items, memory):
+  '''Runs a scenario with its output discarded and returns its measurements'''
+  mock_synapse.state['requests'] = {}
+  if memory == True:
+    tracemalloc.start()
+  started = time.monotonic()
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    count = run()
+  seconds = time.monotonic() - started
+  peak = None
+  if memory == True:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  if count == None:
+    count = items
+  result = {
+    'scenario': name,
+    'seconds': round(seconds, 3),
+    'items': count,
+    'per_second': round(count / seconds, 1) if seconds > 0 else None,
+    'requests': sum(mock_synapse.state['requests'].values()),
+    'requests_by_endpoint': dict(mock_synapse.state['requests']),
+    'traced_peak_bytes': peak,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+  if name == 'retention':
+    result['phases'] = phases
+  return result
+
+
+def retention(workdir):
+  '''Runs synapse-tools retention as cron would, keeping the time of each phase'''
+  global phases
+  synapse_metrics.reset()
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  # config.json is read again from workdir
+  core.config = None
+  try:
+    retention_command.main([])
+  finally:
+    with open(os.path.join(workdir, 'metrics.json'), 'r') as json_file:
+      phases = json.load(json_file)['phases']
+    os.chdir(cwd)
+
+
+def list_rooms(config, headers):
+  '''Lists every room like synapse-tools rooms -l'''
+  return len(list(core.iter_rooms(headers)))
+
+
+def delete_abandoned(config, headers):
+  '''Deletes rooms without members like synapse-tools rooms -p'''
+  return len(core.delete_abandoned(headers, config['purge_concurrency']))
+
+
+def list_users(config, headers):
+  '''Lists every user like synapse-tools users -la'''
+  return len(list(users.iter_users(headers, {'deactivated': 'true', 'guests': 'true'})))
+
+
+def print_results(results, output):
+  '''Prints the measurements as a table or JSON'''
+  if output == 'json':
+    print(json.dumps(results, indent=4))
+    return
+  print('%-18s %10s %10s %12s %10s %14s' % ('scenario', 'seconds', 'items', 'items/s', 'requests', 'peak MiB'))
+  for result in results:
+    peak = '-'
+    if result['traced_peak_bytes'] != None:
+      peak = str(round(result['traced_peak_bytes'] / 1048576, 1))
+    print('%-18s %10s %10s %12s %10s %14s' % (result['scenario'], result['seconds'], result['items'],
+                                               result['per_second'], result['requests'], peak))
+    for phase, seconds in sorted(result.get('phases', {}).items()):
+      print('  %-16s %10s' % (phase, round(seconds, 3)))
+  print('Max RSS: ' + str(round(results[-1]['maxrss_kb'] / 1024, 1)) + ' MiB')
+
+
+def main():
+  '''Generates the data, starts the mock and runs every scenario'''
+  parser = argparse.ArgumentParser(description='Benchmarks synapse-tools against a mock Synapse.')
+  parser.add_argument('--db', help='homeserver.db to use, generated in a temp dir if not given')
+  parser.add_argument('--rooms', help='number of rooms', type=int, default=10000)
+  parser.add_argument('--events', help='number of events', type=int, default=1000000)
+  parser.add_argument('--users', help='number of users', type=int, default=1000)
+  parser.add_argument('--media', help='number of uploaded media files', type=int, default=10000)
+  parser.add_argument('--days', help='days of history the events are spread over', type=float, default=30)
+  parser.add_argument('--expired', help='fraction of the history older than rp_hours', type=float, default=0.1)
+  parser.add_argument('--server-name', help='server_name of the rooms and users', default='bench.local')
+  parser.add_argument('--latency', help='seconds the mock adds to every response', type=float, default=0.0)
+  parser.add_argument('--rate-limit', help='fraction of redactions the mock answers with 429', type=float, default=0.0)
+  parser.add_argument('--job-seconds', help='seconds the mock takes per purge or deletion', type=float, default=0.0)
+  parser.add_argument('--poll-interval', help='seconds between job status polls', type=float, default=0.1)
+  parser.add_argument('--concurrency', help='room workers', type=int, default=4)
+  parser.add_argument('--purge-concurrency', help='purges and deletions in flight', type=int, default=2)
+  parser.add_argument('--redaction', help='redaction mode', choices=['events', 'admin'], default='events')
+  parser.add_argument('--scenarios', help='scenarios to run', nargs='+',
+                      choices=['retention', 'list_rooms', 'list_users', 'delete_abandoned'],
+                      default=['list_rooms', 'list_users', 'retention', 'delete_abandoned'])
+  parser.add_argument('--memory', help='trace Python allocations, which slows the run down', action='store_true')
+  parser.add_argument('--format', help='output format', choices=['table', 'json'], default='table')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as workdir:
+    database = args.db
+    if database == None:
+      database = os.path.join(workdir, 'homeserver.db')
+      started = time.monotonic()
+      make_homeserver_db.generate(database, args.rooms, args.events, args.users, args.days, 0.01, args.server_name,
+                                  args.media)
+      print('Generated ' + database + ' in ' + str(round(time.monotonic() - started, 1)) + 's', file=sys.stderr)
+    mock_synapse.load_rooms(args.rooms, args.server_name)
+    mock_synapse.load_users(args.users, args.server_name)
+    mock_synapse.state['database'] = database
+    server = mock_synapse.serve(0, args.latency, args.rate_limit, args.job_seconds)
+    baseurl = 'http://127.0.0.1:' + str(server.server_address[1])
+    hours = max(int(args.days * 24 * (1 - args.expired)), 1)
+    config = write_config(workdir, baseurl, database, hours, args)
+    core.configure(config)
+    headers = {'Authorization': 'Bearer benchtoken', 'Content-Type': 'application/json'}
+    scenarios = {
+      'retention': lambda: retention(workdir),
+      'list_rooms': lambda: list_rooms(config, headers),
+      'list_users': lambda: list_users(config, headers),
+      'delete_abandoned': lambda: delete_abandoned(config, headers),
+    }
+    results = []
+    for name in args.scenarios:
+      items = args.rooms
+      if name == 'retention':
+        # Expired events, all of which are looked at on a first run
+        items = int(args.events * args.expired)
+      elif name == 'list_users':
+        items = args.users
+      results.append(measure(name, scenarios[name], items, args.memory))
+    server.shutdown()
+  print_results(results, args.format)
+
+
+if __name__ == '__main__':
+  main()
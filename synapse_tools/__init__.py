@@ -0,0 +1,7 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Tools that simplify the administration of Synapse - Matrix.org's reference server.
+The commands are in users, rooms and retention, and are run through cli'''
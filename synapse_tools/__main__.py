@@ -0,0 +1,11 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Runs synapse-tools with python -m synapse_tools'''
+
+from synapse_tools import cli
+
+if __name__ == '__main__':
+  cli.main()
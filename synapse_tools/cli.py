@@ -0,0 +1,46 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''The synapse-tools command, which imports only the subcommand it runs, so
+that -h and mistyped arguments return before requests is ever imported'''
+
+import importlib
+import sys
+
+# Subcommand: (module, what it does)
+COMMANDS = {
+  'users': ('synapse_tools.users', 'manage users (create, deactivate, reset password, list, audit, batch)'),
+  'rooms': ('synapse_tools.rooms', 'list, query and delete rooms'),
+  'retention': ('synapse_tools.retention', 'redact and purge messages older than rp_hours'),
+}
+
+
+def usage():
+  '''Returns the list of subcommands'''
+  lines = ['usage: synapse-tools {' + ','.join(COMMANDS) + '} ...', '', 'Administration of Synapse.', '',
+           'Commands:']
+  for name, (module, help) in COMMANDS.items():
+    lines.append('  %-12s %s' % (name, help))
+  lines = lines + ['', 'Use synapse-tools <command> -h for the arguments of a command.']
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  '''Runs the subcommand named by the first argument with the rest of them'''
+  if argv == None:
+    argv = sys.argv[1:]
+  if len(argv) == 0 or argv[0] in ('-h', '--help'):
+    print(usage())
+    return
+  if argv[0] not in COMMANDS:
+    print(usage(), file=sys.stderr)
+    print('synapse-tools: unknown command ' + argv[0], file=sys.stderr)
+    sys.exit(2)
+  module = importlib.import_module(COMMANDS[argv[0]][0])
+  module.main(argv[1:], prog='synapse-tools ' + argv[0])
+
+
+if __name__ == '__main__':
+  main()
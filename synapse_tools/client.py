@@ -0,0 +1,231 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Pooled HTTP client shared by synapse-tools scripts'''
+
+import json
+import os
+import time
+from synapse_tools import metrics as synapse_metrics
+
+# Requests that can be sent twice without side effects are retried on
+# read errors and server errors too, the rest only when they never left
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# Display name of the devices the scripts log in with, so that
+# leftover ones can be told apart from those of people
+DEVICE_NAME = 'synapse-tools'
+
+# Status polls in a row that can fail before a job is given up on
+POLL_ERRORS = 10
+
+session = None
+timeout = None
+poll_interval = 5
+job_timeout = 3600
+
+
+def __getattr__(name):
+  '''Imports requests the first time RequestException is looked up, so that
+  commands that stop at -h or a bad argument never pay for importing it'''
+  if name == 'RequestException':
+    import requests
+    return requests.exceptions.RequestException
+  raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
+
+
+def configure(config):
+  '''Creates the keep-alive session shared by all requests from config.json settings'''
+  global session
+  global timeout
+  global poll_interval
+  global job_timeout
+  global RequestException
+  # requests takes longer to import than the rest of a command's start up
+  import requests
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+  RequestException = requests.exceptions.RequestException
+  poll_interval = config.get('poll_interval', 5)
+  job_timeout = config.get('job_timeout', 3600)
+  pool_size = config.get('pool_size', 10)
+  timeout = (config.get('connect_timeout', 5), config.get('read_timeout', 60))
+  retries = Retry(total=config.get('retries', 3),
+                  backoff_factor=0.5,
+                  status_forcelist=(502, 503, 504),
+                  allowed_methods=IDEMPOTENT,
+                  raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+def request(method, url, **kwargs):
+  '''Sends a request over the shared session, recording its status and latency'''
+  if session == None:
+    configure({})
+  kwargs.setdefault('timeout', timeout)
+  started = time.monotonic()
+  try:
+    response = session.request(method, url, **kwargs)
+  except RequestException:
+    synapse_metrics.observe_request(method, url, 'error', time.monotonic() - started)
+    raise
+  synapse_metrics.observe_request(method, url, response.status_code, time.monotonic() - started)
+  return response
+
+
+def get(url, **kwargs):
+  '''Sends a GET request'''
+  return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+  '''Sends a POST request'''
+  return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+  '''Sends a PUT request'''
+  return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+  '''Sends a DELETE request'''
+  return request('DELETE', url, **kwargs)
+
+
+def load_tokens(path):
+  '''Reads the token cache, {public_baseurl: {user: access_token}}'''
+  try:
+    with open(path, 'r') as json_file:
+      return json.load(json_file)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+
+def save_tokens(path, tokens):
+  '''Writes the token cache so that only the user running the script can read it'''
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  with os.fdopen(fd, 'w', encoding='utf-8') as json_file:
+    json.dump(tokens, json_file, indent=4)
+  os.chmod(path, 0o600)
+
+
+def whoami(public_baseurl, token):
+  '''Checks cheaply whether an access token is still valid'''
+  url = str(public_baseurl) + '/_matrix/client/r0/account/whoami'
+  try:
+    request = get(url, headers={'Authorization': 'Bearer ' + token})
+  except RequestException:
+    return False
+  return request.status_code == 200
+
+
+def cached_token(path, public_baseurl, user):
+  '''Returns the cached access token of user if it is still valid'''
+  token = load_tokens(path).get(public_baseurl, {}).get(user)
+  if token != None and whoami(public_baseurl, token) == True:
+    return token
+  return None
+
+
+def cache_token(path, public_baseurl, user, token):
+  '''Caches the access token of user, or forgets it if token is None'''
+  tokens = load_tokens(path)
+  server = tokens.setdefault(public_baseurl, {})
+  if token == None:
+    server.pop(user, None)
+  else:
+    server[user] = token
+  save_tokens(path, tokens)
+
+
+def job_status(headers, url, done='complete', failed=None):
+  '''Gets the status of a server-side job from url: active, complete or failed.
+  done is the status the endpoint reports once the job is over, and failed, if
+  given, tells from the response whether a job that is over failed all the same'''
+  request = get(url, headers=headers)
+  # Synapse forgets about jobs when it restarts
+  if request.status_code == 404:
+    return 'failed'
+  # Anything else, like a 401 or a proxy error page, is retried on the next poll
+  if request.ok == False:
+    raise ValueError(url + ': ' + str(request.status_code))
+  response = request.json()
+  status = response.get('status')
+  if status == done:
+    if failed != None and failed(response):
+      return 'failed'
+    return 'complete'
+  return status
+
+
+def run_jobs(items, start, status, workers, interval=None, stop=None, deadline=None):
+  '''Runs server-side jobs with at most workers of them in flight, polling them
+  every interval seconds, poll_interval by default. start(item) returns a job id
+  and status(job_id) its current status, and new jobs are only started as
+  running ones complete or fail, or not at all once the stop event is set.
+  Jobs still running after deadline seconds, job_timeout by default, or whose
+  status can't be had POLL_ERRORS times in a row, count as failed.
+  Returns [(item, status, seconds)] for the jobs it tried to start'''
+  if interval == None:
+    interval = poll_interval
+  if deadline == None:
+    deadline = job_timeout
+  queue = list(items)
+  running = {}
+  results = []
+  while len(queue) > 0 or len(running) > 0:
+    # Jobs can't be cancelled on the server, so those running are waited for
+    if stop != None and stop.is_set():
+      queue = []
+    while len(queue) > 0 and len(running) < workers:
+      item = queue.pop(0)
+      started = time.monotonic()
+      try:
+        job_id = start(item)
+      except (RequestException, ValueError):
+        job_id = None
+      if job_id == None:
+        results.append((item, 'failed', time.monotonic() - started))
+      else:
+        running[job_id] = (item, started, 0)
+    if len(running) == 0:
+      continue
+    time.sleep(interval)
+    for job_id in list(running.keys()):
+      item, started, errors = running[job_id]
+      try:
+        outcome = status(job_id)
+      except (RequestException, ValueError):
+        outcome = None
+      # Try again on the next poll, unless it keeps failing
+      if outcome == None:
+        errors = errors + 1
+        running[job_id] = (item, started, errors)
+        if errors >= POLL_ERRORS:
+          print('Giving up on ' + str(item) + ': no status after ' + str(errors) + ' polls')
+          outcome = 'failed'
+      else:
+        running[job_id] = (item, started, 0)
+      # Synapse can't be asked to stop a job, but the run can stop waiting for it
+      if outcome not in ('complete', 'failed') and time.monotonic() - started > deadline:
+        print('Giving up on ' + str(item) + ': still ' + str(outcome) + ' after ' + str(round(deadline)) + 's')
+        outcome = 'failed'
+      if outcome in ('complete', 'failed'):
+        running.pop(job_id)
+        results.append((item, outcome, time.monotonic() - started))
+  return results
+
+
+def summarise_jobs(name, results):
+  '''Prints how long each job took and how many completed or failed'''
+  for item, outcome, seconds in results:
+    print(name + ' ' + item + ': ' + outcome + ' in ' + str(round(seconds, 1)) + 's')
+  complete = len([result for result in results if result[1] == 'complete'])
+  print(name + ': ' + str(complete) + ' complete, ' + str(len(results) - complete) + ' failed')
@@ -0,0 +1,280 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Settings, log in and the room APIs shared by the synapse-tools commands'''
+
+import getpass
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from synapse_tools import client
+
+# Read once per process, however many commands ask for it
+config = None
+
+# Set by configure() from config.json, and overridden by -ad and -ap
+server_name = None
+public_baseurl = None
+token_cache = ''
+
+
+def open_config(edit_first=False):
+  '''Open config.json where settings are stored. If it doesn't exist, a template
+  is created and, if edit_first, the command exits so that it is edited first.'''
+  global config
+  if config != None:
+    return config
+  try:
+    with open('config.json', 'r') as json_file:
+      config = json.load(json_file)
+  # If config.json doesn't exist, create a template
+  except FileNotFoundError:
+    create_config()
+    if edit_first == True:
+      print('Edit config.json\r')
+      exit()
+    with open('config.json', 'r') as json_file:
+      config = json.load(json_file)
+  return config
+
+
+def create_config():
+  '''Create config.json.'''
+  s = {}
+  s['server_name'] = 'example.com'
+  s['public_baseurl'] = 'https://matrix.example.com'
+  s['admin'] = 'youradmin'
+  s['password'] = 'yourpassword'
+  s['database'] = '/path/to/your/homeserver.db'
+  s['rp_hours'] = 12
+  s['concurrency'] = 4
+  s['state'] = 'state.db'
+  s['purge_concurrency'] = 2
+  s['pool_size'] = 10
+  s['connect_timeout'] = 5
+  s['read_timeout'] = 60
+  s['retries'] = 3
+  s['poll_interval'] = 5
+  s['job_timeout'] = 3600
+  s['token_cache'] = ''
+  s['redaction'] = 'events'
+  s['index'] = 'index.db'
+  s['metrics_textfile'] = ''
+  s['metrics_json'] = ''
+  s['sweep_slices'] = 24
+  s['retention'] = []
+  s['busy_timeout'] = 5
+  s['scan_chunk'] = 5000
+  s['scan_pause'] = 0
+  s['media_retention'] = False
+  s['media_size_gt'] = 0
+  s['media_window_hours'] = 168
+  s['maintenance_pages'] = 1000
+  s['maintenance_idle_seconds'] = 5
+  s['maintenance_max_writes'] = 0
+  with open('config.json', 'w', encoding='utf-8') as config:
+    json.dump(s, config, indent=4)
+  os.chmod('config.json', 0o600)
+
+
+def configure(config):
+  '''Sets up the HTTP client and the server settings from config.json'''
+  global server_name
+  global public_baseurl
+  global token_cache
+  client.configure(config)
+  server_name = config['server_name']
+  public_baseurl = config['public_baseurl']
+  token_cache = config.get('token_cache', '')
+
+
+def add_server_arguments(group):
+  '''Adds the arguments that override the server settings of config.json'''
+  group.add_argument('-au', help='alternative Synapse admin user', type=str)
+  group.add_argument('-ad', help='alternative (sub)domain', type=str)
+  group.add_argument('-ap', help='alternative public_baseurl i.e. https://matrix.examle.com.', type=str)
+
+
+def override(config, args):
+  '''Applies -ad, -au and -ap, exiting if a setting is still the template's,
+  and returns the fully qualified admin user'''
+  global server_name
+  global public_baseurl
+  admin = config['admin']
+  # We need either a server_name in config.py or -ad server_name
+  if server_name == '' or server_name == 'example.com' and args.ad == None:
+    print('No server_name in config.json. Use -ad example.com.')
+    exit()
+  if args.ad != None:
+    server_name = args.ad
+
+  # We need either an admin user in config.py or -au user
+  if admin == '' or admin == 'youradmin' and args.au == None:
+    print('No admin user in config.json. Use -au user.')
+    exit()
+  if args.au != None:
+    admin = args.au
+
+  # We need either public_baseurl in config.py or -ap url
+  if public_baseurl == '' or public_baseurl == 'https://matrix.example.com' and args.ap == None:
+    print('No public_baseurl in config.json. Use -ap url.')
+    exit()
+  if args.ap != None:
+    public_baseurl = args.ap
+  return fq_user(admin, server_name)
+
+
+def fq_user(user, server_name):
+  '''Returns a fully qualified user id'''
+  fq_user = '@' + user + ':' + server_name
+  return fq_user
+
+
+def log_in(user, passw=None, file=None):
+  '''Gets a Synapse login token, asking for the password if passw is None.
+  The outcome is printed to file, stdout by default'''
+  # A cached token saves logging in, and a new device, on every run
+  if token_cache != '':
+    token = client.cached_token(token_cache, public_baseurl, user)
+    if token != None:
+      print('Log in: cached token', file=file)
+      return token
+  url = str(public_baseurl) + '/_matrix/client/r0/login'
+  if passw == None:
+    try:
+      passw = getpass.getpass(user + ' password: ')
+    except KeyboardInterrupt:
+      print('\r')
+      exit()
+  json = {'type':'m.login.password', 'user':  user, 'password':passw,
+          'initial_device_display_name': client.DEVICE_NAME}
+  request = client.post(url, json=json)
+  print('Log in: ' + str(request), file=file)
+  response = request.json()
+  token = response['access_token']
+  if token_cache != '':
+    client.cache_token(token_cache, public_baseurl, user, token)
+  return token
+
+
+def log_out(headers, file=None):
+  '''Logs out to invalidate the one-time access token'''
+  # Cached tokens are kept for the next run
+  if token_cache != '':
+    return
+  url = str(public_baseurl) + '/_matrix/client/r0/logout'
+  request = client.post(url, headers=headers)
+  print('Log out: ' + str(request), file=file)
+
+
+def get_rooms_page(headers, params, start, limit):
+  '''Gets a page of rooms starting at offset start'''
+  url = str(public_baseurl) + '/_synapse/admin/v1/rooms'
+  params = dict(params or {})
+  params['limit'] = limit
+  if start != None:
+    params['from'] = start
+  request = client.get(url, headers=headers, params=params)
+  return request.json()
+
+
+def paginate(fetch, token_key, items_key, prefetch=True):
+  '''Yields every item of a paged admin API, where fetch(start) gets the page
+  starting at token start, or the first one if start is None, items_key holds
+  its items and token_key where the next page starts. Optionally fetches the
+  next page while the current one is processed'''
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    page = fetch(None)
+    while True:
+      token = page.get(token_key)
+      following = None
+      if token != None and prefetch == True:
+        following = executor.submit(fetch, token)
+      for item in page[items_key]:
+        yield item
+      if token == None:
+        break
+      if following != None:
+        page = following.result()
+      else:
+        page = fetch(token)
+
+
+def iter_rooms(headers, params=None, limit=500, prefetch=True):
+  '''Yields every room on a Synapse server following next_batch.
+  params are passed on to the rooms API, i.e. order_by and dir'''
+  return paginate(lambda start: get_rooms_page(headers, params, start, limit), 'next_batch', 'rooms', prefetch)
+
+
+def list_rooms(headers, txt):
+  '''List all rooms on a Synapse server, streaming
+  them to a NDJSON txt file too if requested'''
+  if txt == False:
+    yield from iter_rooms(headers)
+    return
+  with open(str(server_name) + '_rooms.txt', 'w', encoding='utf-8') as out_file:
+    for room in iter_rooms(headers):
+      out_file.write(json.dumps(room) + '\n')
+      yield room
+
+
+def start_delete(headers, room_id):
+  '''Starts deleting and purging a room and returns the delete_id'''
+  url = str(public_baseurl) + '/_synapse/admin/v2/rooms/' + room_id
+  json = {'purge': True}
+  request = client.delete(url, json=json, headers=headers)
+  response = request.json()
+  print('Deleting room ' + room_id + ': ' + str(request))
+  return response.get('delete_id')
+
+
+def delete_status(headers, delete_id):
+  '''Gets the status of a room deletion: shutting_down, purging, complete or failed'''
+  url = str(public_baseurl) + '/_synapse/admin/v2/rooms/delete_status/' + delete_id
+  return client.job_status(headers, url)
+
+
+def delete_rooms(headers, rooms, workers, stop=None):
+  '''Deletes and purges rooms with at most workers deletions in flight,
+  starting no more of them once the stop event is set'''
+  results = client.run_jobs(rooms, lambda room_id: start_delete(headers, room_id),
+                            lambda delete_id: delete_status(headers, delete_id), workers, stop=stop)
+  client.summarise_jobs('Delete', results)
+  return results
+
+
+def room_age(headers, room_id):
+  '''Returns the hours since a room was created'''
+  url = str(public_baseurl) + '/_synapse/admin/v1/rooms/' + room_id + '/state'
+  request = client.get(url, headers=headers)
+  response = request.json()
+  for event in response['state']:
+    if event['type'] == 'm.room.create':
+      return (time.time() * 1000 - event['origin_server_ts']) / 3600000
+  return 0
+
+
+def find_abandoned(headers, order_by='joined_members', min_age=None):
+  '''Finds rooms where order_by, joined_members or joined_local_members, is 0
+  and that are at least min_age hours old'''
+  # Synapse sorts these largest first and dir=b turns it around, so the
+  # scan can stop at the first room that has members
+  params = {'order_by': order_by, 'dir': 'b'}
+  abandoned = []
+  for room in iter_rooms(headers, params, prefetch=False):
+    if room[order_by] > 0:
+      break
+    if min_age != None and room_age(headers, room['room_id']) < min_age:
+      continue
+    abandoned.append(room['room_id'])
+  return abandoned
+
+
+def delete_abandoned(headers, workers, order_by='joined_members', min_age=None, stop=None):
+  '''Delete and purge rooms with "joined_members": 0, or no joined_local_members'''
+  # Deleting rooms shifts the pages, so the candidates are all found first
+  abandoned = find_abandoned(headers, order_by, min_age)
+  return delete_rooms(headers, abandoned, workers, stop)
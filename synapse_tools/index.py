@@ -0,0 +1,127 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Local sqlite index of rooms and users for offline queries'''
+
+import json
+import os
+import sqlite3
+import time
+
+# Columns kept for each table, the first one being its key. The whole
+# record returned by the admin API is kept in data too
+COLUMNS = {
+  'rooms': ['room_id', 'name', 'canonical_alias', 'joined_members', 'joined_local_members', 'creator', 'public', 'room_type'],
+  'users': ['name', 'displayname', 'admin', 'deactivated', 'user_type', 'creation_ts', 'last_seen_ts'],
+}
+
+
+def open_index(path):
+  '''Opens the index, creating it readable only by the user running the script'''
+  exists = os.path.exists(path)
+  index = sqlite3.connect(path)
+  if exists == False:
+    os.chmod(path, 0o600)
+  for table, columns in COLUMNS.items():
+    index.execute('CREATE TABLE IF NOT EXISTS ' + table + ' \
+                  (' + columns[0] + ' TEXT PRIMARY KEY, ' + ', '.join(columns[1:]) + ', data TEXT NOT NULL);')
+  index.execute('CREATE INDEX IF NOT EXISTS rooms_joined_members ON rooms (joined_members);')
+  index.execute('CREATE INDEX IF NOT EXISTS users_last_seen_ts ON users (last_seen_ts);')
+  index.execute('CREATE INDEX IF NOT EXISTS users_admin ON users (admin, deactivated);')
+  index.execute('CREATE TABLE IF NOT EXISTS refreshes (name TEXT PRIMARY KEY, ts INTEGER NOT NULL);')
+  return index
+
+
+def refresh(index, table, records):
+  '''Syncs a table with records streamed from an admin list API, only writing
+  the ones that are new or changed and dropping those no longer listed.
+  Returns (added, changed, removed)'''
+  columns = COLUMNS[table]
+  key = columns[0]
+  insert = 'INSERT OR REPLACE INTO ' + table + ' (' + ', '.join(columns) + ', data) \
+           VALUES (' + ', '.join(['?'] * (len(columns) + 1)) + ');'
+  index.execute('CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY);')
+  index.execute('DELETE FROM seen;')
+  added = 0
+  changed = 0
+  for record in records:
+    data = json.dumps(record, sort_keys=True)
+    index.execute('INSERT OR IGNORE INTO seen (key) VALUES (?);', (record[key],))
+    row = index.execute('SELECT data FROM ' + table + ' WHERE ' + key + ' = ?;', (record[key],)).fetchone()
+    if row == None:
+      added = added + 1
+    elif row[0] == data:
+      continue
+    else:
+      changed = changed + 1
+    index.execute(insert, [record.get(column) for column in columns] + [data])
+  removed = index.execute('DELETE FROM ' + table + ' WHERE ' + key + ' NOT IN (SELECT key FROM seen);').rowcount
+  index.execute('INSERT OR REPLACE INTO refreshes (name, ts) VALUES (?, ?);', (table, int(time.time() * 1000)))
+  index.commit()
+  return added, changed, removed
+
+
+def refreshed(index, table):
+  '''Returns when a table was last refreshed in ms, or None if it never was'''
+  row = index.execute('SELECT ts FROM refreshes WHERE name = ?;', (table,)).fetchone()
+  if row == None:
+    return None
+  return row[0]
+
+
+def age(index, table):
+  '''Describes how old a table is, for queries to print along with their results'''
+  ts = refreshed(index, table)
+  if ts == None:
+    return table.capitalize() + ' index: never refreshed, use --refresh'
+  hours = (time.time() * 1000 - ts) / 3600000
+  return table.capitalize() + ' index: refreshed ' + str(round(hours, 1)) + ' hours ago'
+
+
+def like(text):
+  '''Returns a LIKE pattern matching text anywhere, with wildcards in text escaped'''
+  text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  return '%' + text + '%'
+
+
+def query(index, table, conditions, params):
+  '''Yields the records of table that match all conditions'''
+  sql = 'SELECT data FROM ' + table
+  if len(conditions) > 0:
+    sql = sql + ' WHERE ' + ' AND '.join(conditions)
+  sql = sql + ' ORDER BY ' + COLUMNS[table][0] + ';'
+  for row in index.execute(sql, params):
+    yield json.loads(row[0])
+
+
+def query_rooms(index, name=None, members_lt=None):
+  '''Yields rooms whose name or alias contains name, with fewer than members_lt members'''
+  conditions = []
+  params = []
+  if name != None:
+    conditions.append('(name LIKE ? ESCAPE \'\\\' OR canonical_alias LIKE ? ESCAPE \'\\\')')
+    params = params + [like(name), like(name)]
+  if members_lt != None:
+    conditions.append('joined_members < ?')
+    params.append(members_lt)
+  return query(index, 'rooms', conditions, params)
+
+
+def query_users(index, name=None, admins=False, deactivated=False, seen_before=None):
+  '''Yields users whose id or display name contains name, only admins or
+  deactivated ones if asked to, and not seen since seen_before (ms) if given'''
+  conditions = []
+  params = []
+  if name != None:
+    conditions.append('(name LIKE ? ESCAPE \'\\\' OR displayname LIKE ? ESCAPE \'\\\')')
+    params = params + [like(name), like(name)]
+  if admins == True:
+    conditions.append('admin')
+  if deactivated == True:
+    conditions.append('deactivated')
+  if seen_before != None:
+    conditions.append('(last_seen_ts IS NULL OR last_seen_ts < ?)')
+    params.append(seen_before)
+  return query(index, 'users', conditions, params)
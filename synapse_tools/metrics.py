@@ -0,0 +1,187 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''Run metrics for synapse-tools scripts, written as a Prometheus
+node_exporter textfile and/or a JSON summary'''
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Path segments that identify a room, event, user, alias or job are folded
+# so that requests are counted per endpoint rather than per URL
+IDS = re.compile(r'/(?:[!$@#]|%21|%24|%40|%23)[^/]*')
+JOBS = re.compile(r'/(purge_history_status|delete_status|redact_status)/[^/]+')
+
+# Every update happens holding lock, since room workers send requests too
+lock = threading.Lock()
+started = time.time()
+phases = {}
+counters = {}
+requests = {}
+latencies = {}
+
+
+def reset():
+  '''Forgets everything recorded so far'''
+  global started
+  with lock:
+    started = time.time()
+    phases.clear()
+    counters.clear()
+    requests.clear()
+    latencies.clear()
+
+
+def endpoint(url):
+  '''Returns the path of url with ids replaced by placeholders'''
+  path = re.sub(r'^[a-z]+://[^/]+', '', url).split('?')[0]
+  path = JOBS.sub(r'/\1/<id>', path)
+  return IDS.sub('/<id>', path)
+
+
+def observe_request(method, url, status, seconds):
+  '''Records a request, status being its HTTP status or error if it never got one'''
+  key = (method, endpoint(url))
+  with lock:
+    requests[key + (str(status),)] = requests.get(key + (str(status),), 0) + 1
+    histogram = latencies.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+    for n, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        histogram['buckets'][n] = histogram['buckets'][n] + 1
+    histogram['sum'] = histogram['sum'] + seconds
+    histogram['count'] = histogram['count'] + 1
+
+
+def count(name, value=1):
+  '''Adds value to the counter name'''
+  with lock:
+    counters[name] = counters.get(name, 0) + value
+
+
+def add_phase(name, seconds):
+  '''Adds seconds to the wall time of phase name'''
+  with lock:
+    phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def phase(name):
+  '''Times the block as phase name'''
+  phase_started = time.monotonic()
+  try:
+    yield
+  finally:
+    add_phase(name, time.monotonic() - phase_started)
+
+
+def timed(name, items):
+  '''Yields from items, timing how long producing them takes as phase name.
+  This separates a lazy query from the work done on what it yields'''
+  items = iter(items)
+  while True:
+    item_started = time.monotonic()
+    try:
+      item = next(items)
+    except StopIteration:
+      add_phase(name, time.monotonic() - item_started)
+      return
+    add_phase(name, time.monotonic() - item_started)
+    yield item
+
+
+def summary(job, success):
+  '''Returns everything recorded as a dict'''
+  with lock:
+    return {
+      'job': job,
+      'success': success,
+      'started': started,
+      'seconds': time.time() - started,
+      'phases': dict(phases),
+      'counters': dict(counters),
+      'requests': [{'method': method, 'endpoint': path, 'status': status, 'count': n}
+                   for (method, path, status), n in sorted(requests.items())],
+      'latencies': [{'method': method, 'endpoint': path, 'buckets': dict(zip(BUCKETS, histogram['buckets'])),
+                     'sum': histogram['sum'], 'count': histogram['count']}
+                    for (method, path), histogram in sorted(latencies.items())],
+    }
+
+
+def labels(**values):
+  '''Formats Prometheus labels'''
+  pairs = []
+  for name, value in values.items():
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    pairs.append(name + '="' + value + '"')
+  return '{' + ','.join(pairs) + '}'
+
+
+def textfile(job, success):
+  '''Returns everything recorded in the Prometheus text exposition format'''
+  report = summary(job, success)
+  lines = [
+    '# HELP synapse_tools_last_run_success Whether the last run finished without an exception.',
+    '# TYPE synapse_tools_last_run_success gauge',
+    'synapse_tools_last_run_success' + labels(job=job) + ' ' + str(int(success)),
+    '# HELP synapse_tools_last_run_timestamp_seconds When the last run started.',
+    '# TYPE synapse_tools_last_run_timestamp_seconds gauge',
+    'synapse_tools_last_run_timestamp_seconds' + labels(job=job) + ' ' + str(report['started']),
+    '# HELP synapse_tools_run_seconds Wall time of the last run.',
+    '# TYPE synapse_tools_run_seconds gauge',
+    'synapse_tools_run_seconds' + labels(job=job) + ' ' + str(report['seconds']),
+    '# HELP synapse_tools_phase_seconds Wall time of each phase of the last run.',
+    '# TYPE synapse_tools_phase_seconds gauge',
+  ]
+  for name, seconds in sorted(report['phases'].items()):
+    lines.append('synapse_tools_phase_seconds' + labels(job=job, phase=name) + ' ' + str(seconds))
+  lines = lines + [
+    '# HELP synapse_tools_items Rooms, events, purges and deletions handled by the last run.',
+    '# TYPE synapse_tools_items gauge',
+  ]
+  for name, value in sorted(report['counters'].items()):
+    lines.append('synapse_tools_items' + labels(job=job, item=name) + ' ' + str(value))
+  lines = lines + [
+    '# HELP synapse_tools_requests Requests sent to Synapse by the last run.',
+    '# TYPE synapse_tools_requests gauge',
+  ]
+  for request in report['requests']:
+    lines.append('synapse_tools_requests' + labels(job=job, method=request['method'], endpoint=request['endpoint'],
+                                                   status=request['status']) + ' ' + str(request['count']))
+  lines = lines + [
+    '# HELP synapse_tools_request_seconds Latency of the requests sent to Synapse by the last run.',
+    '# TYPE synapse_tools_request_seconds histogram',
+  ]
+  for latency in report['latencies']:
+    for bound, n in latency['buckets'].items():
+      lines.append('synapse_tools_request_seconds_bucket' + labels(job=job, method=latency['method'],
+                   endpoint=latency['endpoint'], le=bound) + ' ' + str(n))
+    common = labels(job=job, method=latency['method'], endpoint=latency['endpoint'])
+    lines.append('synapse_tools_request_seconds_bucket' + common[:-1] + ',le="+Inf"} ' + str(latency['count']))
+    lines.append('synapse_tools_request_seconds_sum' + common + ' ' + str(latency['sum']))
+    lines.append('synapse_tools_request_seconds_count' + common + ' ' + str(latency['count']))
+  return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, text):
+  '''Writes text to path through a temp file so that readers never see half of it'''
+  temp = path + '.' + str(os.getpid()) + '.tmp'
+  with open(temp, 'w', encoding='utf-8') as output:
+    output.write(text)
+  os.replace(temp, path)
+
+
+def write(config, job, success=True):
+  '''Writes the metrics to the metrics_textfile and metrics_json set in config.json'''
+  if config.get('metrics_textfile', '') != '':
+    write_atomically(config['metrics_textfile'], textfile(job, success))
+  if config.get('metrics_json', '') != '':
+    write_atomically(config['metrics_json'], json.dumps(summary(job, success), indent=4) + '\n')
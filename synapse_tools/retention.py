@@ -0,0 +1,952 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''synapse-tools retention: redacts and purges messages older than rp_hours'''
+
+import argparse
+import json
+import sqlite3
+from datetime import datetime
+import os
+import pathlib
+import sys
+import time
+import itertools
+import fnmatch
+import signal
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from synapse_tools import client
+from synapse_tools import core
+from synapse_tools import metrics as synapse_metrics
+
+
+# Guards the state store, which room workers write to as they go
+state_lock = threading.Lock()
+
+# Rooms whose senders are looked for in one statement, so that sender
+# discovery never holds a read transaction on the database for long
+SENDER_ROOMS = 100
+
+# Set on SIGTERM in daemon mode. Room workers stop between events and no
+# new purges or deletions are started, but those running are waited for
+stopping = threading.Event()
+
+# Messages older than each room's cutoff that are past its watermark. CROSS JOIN keeps
+# target_rooms as the outer loop and NOT outlier lets SQLite walk the
+# (room_id, origin_server_ts) index Synapse keeps on events
+EXPIRED_EVENTS = 'FROM target_rooms \
+                 CROSS JOIN events \
+                 ON events.room_id = target_rooms.room_id \
+                 WHERE NOT events.outlier \
+                 AND events.origin_server_ts >= target_rooms.until_ts \
+                 AND events.origin_server_ts < target_rooms.cutoff \
+                 AND (target_rooms.ts IS NULL \
+                 OR (events.origin_server_ts, events.stream_ordering) > (target_rooms.ts, target_rooms.stream_ordering)) \
+                 AND events.type IN (\'m.room.encrypted\', \'m.room.message\')'
+
+
+def get_rooms(headers, target):
+  '''Gets all rooms'''
+  for room in core.iter_rooms(headers):
+    target[room['room_id']] = {'joined_members': room['joined_members'],
+                               'canonical_alias': room.get('canonical_alias'),
+                               'room_type': room.get('room_type')}
+  return target
+
+
+def check_rules(rules):
+  '''Returns what is wrong with the retention rules in config.json, if anything'''
+  for rule in rules:
+    if len(set(rule.keys()) & {'room_id', 'alias', 'room_type'}) != 1 or 'hours' not in rule:
+      return 'Each retention rule needs one of room_id, alias or room_type, and hours: ' + json.dumps(rule)
+  return None
+
+
+def retention_hours(room_id, room, rules, hours):
+  '''Returns the hours a room's messages are kept for, None meaning forever. A rule
+  for its room_id comes first, then one matching its canonical alias, then one
+  for its room type, in the order they are listed, and then rp_hours'''
+  for rule in rules:
+    if rule.get('room_id') == room_id:
+      return rule['hours']
+  for rule in rules:
+    alias = room.get('canonical_alias')
+    if 'alias' in rule and alias != None and fnmatch.fnmatchcase(alias, rule['alias']):
+      return rule['hours']
+  for rule in rules:
+    if 'room_type' in rule and rule['room_type'] == room.get('room_type'):
+      return rule['hours']
+  return hours
+
+
+def resolve_cutoffs(target, rules, hours, now):
+  '''Works out the cutoff of each room from the retention rules, dropping
+  the rooms whose messages are kept forever'''
+  for room_id in list(target.keys()):
+    room_hours = retention_hours(room_id, target[room_id], rules, hours)
+    if room_hours == None:
+      del target[room_id]
+    else:
+      target[room_id]['until'] = now - int(room_hours * 3600000)
+  return target
+
+
+def open_state(path):
+  '''Opens the local state store where the retention watermarks are kept'''
+  exists = os.path.exists(path)
+  # Room workers save their progress too, always holding state_lock
+  state = sqlite3.connect(path, check_same_thread=False)
+  if exists == False:
+    os.chmod(path, 0o600)
+  # pending is the cutoff a room has been redacted up to but not purged yet
+  state.execute('CREATE TABLE IF NOT EXISTS watermarks \
+                (room_id TEXT PRIMARY KEY, until_ts INTEGER NOT NULL, ts INTEGER, stream_ordering INTEGER, pending INTEGER);')
+  # State files written before pending existed
+  columns = [row[1] for row in state.execute('PRAGMA table_info(watermarks);')]
+  if 'pending' not in columns:
+    state.execute('ALTER TABLE watermarks ADD COLUMN pending INTEGER;')
+  return state
+
+
+def save_watermark(state, room_id, until, position, pending=None):
+  '''Records how far a room has been swept. With until, the room is done up to
+  that cutoff, purge included. Otherwise position is the (origin_server_ts,
+  stream_ordering) of the last event redacted, if any, and pending the cutoff
+  the room is fully redacted up to and waits to be purged to, if it is'''
+  if position == None:
+    position = (None, None)
+  with state_lock:
+    if until != None:
+      state.execute('INSERT OR REPLACE INTO watermarks (room_id, until_ts, ts, stream_ordering, pending) \
+                    VALUES (?, ?, NULL, NULL, NULL);', (room_id, until))
+    else:
+      state.execute('INSERT INTO watermarks (room_id, until_ts, ts, stream_ordering, pending) \
+                    VALUES (?, 0, ?, ?, ?) \
+                    ON CONFLICT (room_id) DO UPDATE \
+                    SET ts = COALESCE(excluded.ts, ts), stream_ordering = COALESCE(excluded.stream_ordering, stream_ordering), \
+                    pending = COALESCE(excluded.pending, pending);', (room_id,) + position + (pending,))
+    state.commit()
+
+
+def advance_watermarks(state, target):
+  '''Moves rooms with nothing to redact or purge, and where nothing failed, up to their cutoff'''
+  rooms = [(room_id, target[room_id]['until']) for room_id in target.keys()
+           if keys_exist(target, room_id, 'failed') == False and purge_candidate(target, room_id) == False]
+  with state_lock:
+    state.executemany('INSERT OR REPLACE INTO watermarks (room_id, until_ts, ts, stream_ordering, pending) \
+                      VALUES (?, ?, NULL, NULL, NULL);', rooms)
+    state.commit()
+  return target
+
+
+def advance_purged(state, target, purged):
+  '''Moves rooms whose purge completed up to their cutoff. Those whose purge
+  failed keep their pending cutoff, so that the next run purges them again'''
+  rooms = [(room_id, target[room_id]['until']) for room_id, job_status, seconds in purged if job_status == 'complete']
+  with state_lock:
+    state.executemany('INSERT OR REPLACE INTO watermarks (room_id, until_ts, ts, stream_ordering, pending) \
+                      VALUES (?, ?, NULL, NULL, NULL);', rooms)
+    state.commit()
+  return target
+
+
+def open_database(target, state):
+  '''Opens the database and loads the target rooms into it'''
+  conn = connect_database()
+  load_targets(conn, target, state)
+  return conn
+
+
+def connect_database():
+  '''Opens the database read-only with the temp tables event discovery joins
+  against, waiting up to busy_timeout seconds whenever Synapse has it locked'''
+  # Temp tables live in their own database, which stays writable
+  uri = pathlib.Path(database).resolve().as_uri() + '?mode=ro'
+  conn = sqlite3.connect(uri, uri=True, timeout=busy_timeout)
+  # cutoff is where the room's retention ends, until_ts, ts and stream_ordering its watermark
+  conn.execute('CREATE TEMP TABLE target_rooms \
+               (room_id TEXT PRIMARY KEY, cutoff INTEGER NOT NULL, until_ts INTEGER NOT NULL, ts INTEGER, stream_ordering INTEGER);')
+  # Senders whose messages are redacted in bulk with the admin API
+  conn.execute('CREATE TEMP TABLE bulk_senders (room_id TEXT, sender TEXT, PRIMARY KEY (room_id, sender));')
+  return conn
+
+
+def load_targets(conn, target, state):
+  '''Loads the target rooms, with their cutoff and how far each of them has been
+  swept, into a temp table to join against, replacing those of a previous sweep'''
+  watermarks = {}
+  for room_id, until_ts, ts, stream_ordering, pending in state.execute('SELECT room_id, until_ts, ts, stream_ordering, pending \
+                                                                        FROM watermarks;'):
+    watermarks[room_id] = (until_ts, ts, stream_ordering)
+    # Redacted events are behind the watermark, so the room would not be found again
+    if pending != None and room_id in target:
+      target[room_id]['pending'] = pending
+  conn.execute('DELETE FROM target_rooms;')
+  conn.execute('DELETE FROM bulk_senders;')
+  rooms = ((room_id, target[room_id]['until']) + watermarks.get(room_id, (0, None, None)) for room_id in target.keys())
+  conn.executemany('INSERT INTO target_rooms (room_id, cutoff, until_ts, ts, stream_ordering) VALUES (?, ?, ?, ?, ?);', rooms)
+  conn.commit()
+
+
+def fetch_rows(cursor, size=1000):
+  '''Streams the rows of a query without fetching them all at once'''
+  while True:
+    rows = cursor.fetchmany(size)
+    if len(rows) == 0:
+      break
+    for row in rows:
+      yield row
+
+
+def fetch_chunks(conn, sql, key):
+  '''Streams the rows of a keyset-paginated query scan_chunk rows at a time,
+  pausing scan_pause seconds between chunks. Each chunk is a statement of its
+  own, so no read transaction outlives it and Synapse can checkpoint its WAL.
+  sql takes the first column of the last key, the last key and the chunk
+  size, and key(row) returns a row's key'''
+  last = ('', 0, 0)
+  while True:
+    rows = conn.execute(sql, (last[0],) + last + (scan_chunk,)).fetchall()
+    for row in rows:
+      yield row
+    if len(rows) < scan_chunk:
+      break
+    last = key(rows[-1])
+    if scan_pause > 0:
+      time.sleep(scan_pause)
+
+
+def get_tokens(conn, target):
+  '''Gets a member's token per room'''
+  sql = 'SELECT target_rooms.room_id, access_tokens.token \
+        FROM target_rooms \
+        INNER JOIN rooms \
+        ON rooms.room_id = target_rooms.room_id \
+        INNER JOIN access_tokens \
+        ON access_tokens.user_id = rooms.creator;'
+  for room_id, token in fetch_rows(conn.execute(sql)):
+    if keys_exist(target, room_id, 'token') == False:
+      target[room_id]['token'] = token
+  return target
+
+
+def get_events(conn):
+  '''Streams events older than each room's cutoff that are past its watermark as
+  (room_id, ((event_id, origin_server_ts, stream_ordering), ...), skipped), one room
+  at a time, where skipped is how many of them were already redacted'''
+  sql = 'SELECT events.room_id, events.event_id, events.origin_server_ts, events.stream_ordering, \
+        EXISTS (SELECT 1 FROM redactions WHERE redactions.redacts = events.event_id) ' + EXPIRED_EVENTS + ' \
+        AND NOT EXISTS (SELECT 1 FROM bulk_senders \
+        WHERE bulk_senders.room_id = events.room_id AND bulk_senders.sender = events.sender) \
+        AND target_rooms.room_id >= ? \
+        AND (target_rooms.room_id, events.origin_server_ts, events.stream_ordering) > (?, ?, ?) \
+        ORDER BY target_rooms.room_id, events.origin_server_ts, events.stream_ordering \
+        LIMIT ?;'
+  # Rooms spanning chunks are grouped back together since chunks follow the order of the rows
+  rows = fetch_chunks(conn, sql, lambda row: (row[0], row[2], row[3]))
+  for room_id, room_rows in itertools.groupby(rows, key=lambda row: row[0]):
+    room_events = []
+    skipped = 0
+    for row in room_rows:
+      if row[4] == True:
+        skipped = skipped + 1
+      else:
+        room_events.append(row[1:4])
+    yield room_id, tuple(room_events), skipped
+
+
+def get_senders(conn):
+  '''Finds, per room, the senders of expired messages who have not sent any
+  message since its cutoff, so that all their messages there can be redacted in bulk.
+  Returns {sender: {room_id: (expired, events)}} where events is how many
+  of the sender's events the admin API has to look through'''
+  sql = 'SELECT expired.room_id, expired.sender, expired.count, \
+        (SELECT COUNT(*) FROM events AS own \
+        WHERE own.room_id = expired.room_id AND own.sender = expired.sender AND NOT own.outlier \
+        AND own.type IN (\'m.room.encrypted\', \'m.room.message\', \'m.room.member\')) \
+        FROM (SELECT events.room_id, events.sender, target_rooms.cutoff, COUNT(*) AS count ' + EXPIRED_EVENTS + ' \
+        AND target_rooms.room_id > ? AND target_rooms.room_id <= ? \
+        AND NOT EXISTS (SELECT 1 FROM redactions WHERE redactions.redacts = events.event_id) \
+        GROUP BY events.room_id, events.sender) AS expired \
+        WHERE NOT EXISTS (SELECT 1 FROM events AS recent \
+        WHERE recent.room_id = expired.room_id AND recent.sender = expired.sender AND NOT recent.outlier \
+        AND recent.origin_server_ts >= expired.cutoff \
+        AND recent.type IN (\'m.room.encrypted\', \'m.room.message\'));'
+  rooms = [row[0] for row in conn.execute('SELECT room_id FROM target_rooms ORDER BY room_id;')]
+  senders = {}
+  last = ''
+  for n in range(0, len(rooms), SENDER_ROOMS):
+    if n > 0 and scan_pause > 0:
+      time.sleep(scan_pause)
+    batch = rooms[n:n + SENDER_ROOMS]
+    for room_id, sender, expired, events in conn.execute(sql, (last, batch[-1])).fetchall():
+      senders.setdefault(sender, {})[room_id] = (expired, events)
+    last = batch[-1]
+  return senders
+
+
+def load_bulk_senders(conn, senders):
+  '''Loads the senders redacted in bulk so that get_events() leaves them out'''
+  pairs = [(room_id, sender) for sender in senders.keys() for room_id in senders[sender].keys()]
+  conn.executemany('INSERT INTO bulk_senders (room_id, sender) VALUES (?, ?);', pairs)
+  # An open transaction would keep one snapshot of the database across chunks
+  conn.commit()
+
+
+def redact_senders(conn, state, target, headers, workers):
+  '''Redacts the messages of senders who have only sent expired messages in a room
+  with the admin API, one job per sender, leaving the rest to room workers'''
+  senders = get_senders(conn)
+  load_bulk_senders(conn, senders)
+  results = client.run_jobs(senders.keys(), lambda sender: start_user_redact(headers, sender, senders[sender]),
+                            lambda redact_id: user_redact_status(headers, redact_id), workers, stop=stopping)
+  client.summarise_jobs('Redact', results)
+  for sender, job_status, seconds in results:
+    for room_id, (expired, events) in senders[sender].items():
+      target[room_id]['bulk'] = target[room_id].get('bulk', 0) + expired
+      if job_status != 'complete':
+        target[room_id].setdefault('failed', []).append(sender)
+      else:
+        save_watermark(state, room_id, None, None, target[room_id]['until'])
+  # Rooms where a bulk job failed are left for the next run as a whole
+  failed = [(room_id,) for room_id in target.keys() if keys_exist(target, room_id, 'failed') == True]
+  conn.executemany('DELETE FROM target_rooms WHERE room_id = ?;', failed)
+  conn.commit()
+  return target
+
+
+def start_user_redact(headers, sender, rooms):
+  '''Starts redacting the events of sender in rooms and returns the redact_id'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/user/' + sender + '/redact'
+  # The limit applies per room and counts all of the sender's events there
+  limit = max([events for expired, events in rooms.values()])
+  json = {'rooms': list(rooms.keys()), 'reason': 'Timeout!', 'limit': limit}
+  request = client.post(url, headers=headers, json=json)
+  response = request.json()
+  print('Redacting ' + sender + ' in ' + str(len(rooms)) + ' rooms: ' + str(request))
+  return response.get('redact_id')
+
+
+def user_redact_status(headers, redact_id):
+  '''Gets the status of a user redaction: active, complete or failed'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/user/redact_status/' + redact_id
+  # A completed job can still have failed to redact some of the events
+  return client.job_status(headers, url, 'completed', lambda response: len(response.get('failed_redactions', {})) > 0)
+
+
+def redact_rooms(target, events, workers, state):
+  '''Redacts events older than each room's cutoff, several rooms at a time
+  but keeping the order of the events within each room'''
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = {}
+    skipped = 0
+    for room_id, room_events, room_skipped in events:
+      if stopping.is_set():
+        break
+      target[room_id]['events'] = len(room_events)
+      target[room_id]['skipped'] = room_skipped
+      skipped = skipped + room_skipped
+      # Nothing left to redact, but the room still needs purging
+      if len(room_events) == 0:
+        target[room_id]['failed'] = []
+        save_watermark(state, room_id, None, None, target[room_id]['until'])
+        continue
+      if keys_exist(target, room_id, 'token') == False:
+        print('Skipping room ' + room_id + ': no member token')
+        target[room_id]['failed'] = [event[0] for event in room_events]
+        continue
+      # Only a few rooms are queued ahead of the workers to keep memory bounded
+      if len(futures) >= workers * 2:
+        done, pending = wait(futures, return_when=FIRST_COMPLETED)
+        redacted_rooms(target, futures, done)
+      room_token = target[room_id]['token']
+      future = executor.submit(redact_room, room_id, room_token, room_events, state, target[room_id]['until'])
+      futures[future] = room_id
+    redacted_rooms(target, futures, list(futures))
+  print('Skipped ' + str(skipped) + ' events that were already redacted')
+  return target
+
+
+def redacted_rooms(target, futures, done):
+  '''Collects the results of finished room redactions'''
+  for future in done:
+    room_id = futures.pop(future)
+    failed = future.result()
+    target[room_id]['failed'] = failed
+    redacted = target[room_id]['events'] - len(failed)
+    print('Redacted room ' + room_id + ': ' + str(redacted) + ' ok, ' + str(len(failed)) + ' failed')
+
+
+def redact_room(room_id, room_token, events, state, until, retries=3):
+  '''Redacts the events of a room in order and retries the ones that failed'''
+  failed = []
+  for n, (event_id, ts, stream_ordering) in enumerate(events, 1):
+    # Events not reached before a SIGTERM are left for the next sweep
+    if stopping.is_set():
+      failed = failed + list(events[n - 1:])
+      break
+    if redact_event(room_id, room_token, event_id) == False:
+      failed.append((event_id, ts, stream_ordering))
+    # Saves progress every so often so that a run that crashes resumes from here
+    elif len(failed) == 0 and n % 100 == 0:
+      save_watermark(state, room_id, None, (ts, stream_ordering))
+  # Failed events get another chance once the rest of the room is done
+  for attempt in range(retries):
+    if len(failed) == 0 or stopping.is_set():
+      break
+    time.sleep(2 ** attempt)
+    failed = [event for event in failed if redact_event(room_id, room_token, event[0]) == False]
+  # The room moves up to until once it is purged too
+  if len(failed) == 0:
+    save_watermark(state, room_id, None, events[-1][1:], until)
+  else:
+    # The next run resumes from the first event that could not be redacted
+    first = events.index(failed[0])
+    if first > 0:
+      save_watermark(state, room_id, None, events[first - 1][1:])
+  return [event[0] for event in failed]
+
+
+def redact_event(room_id, room_token, event_id, retries=5):
+  '''Redacts an event, waiting as long as Synapse asks while it rate limits us'''
+  url = str(core.public_baseurl) + "/_matrix/client/api/v1/rooms/" + room_id + "/redact/" + event_id
+  json = {"reason": "Timeout!"}
+  headers = {'Authorization': 'Bearer ' + room_token}
+  backoff = 0.1
+  limited = False
+  for attempt in range(retries):
+    try:
+      request = client.post(url, json=json, headers=headers)
+    except client.RequestException:
+      time.sleep(2 ** attempt)
+      continue
+    if request.status_code != 429:
+      return request.ok
+    # Synapse tells us how long to wait in retry_after_ms. We back off
+    # without it, or if the event is rate limited again after waiting
+    wait = retry_after(request)
+    if wait == None or limited == True:
+      wait = max(wait or 0, backoff)
+      backoff = backoff * 2
+    limited = True
+    time.sleep(wait)
+  return False
+
+
+def retry_after(request):
+  '''Returns the seconds Synapse asks us to wait after a 429, or None if it doesn't say'''
+  try:
+    retry_after_ms = request.json().get('retry_after_ms')
+  except ValueError:
+    return None
+  if retry_after_ms == None:
+    return None
+  return retry_after_ms / 1000
+
+
+def purge_candidate(target, room_id):
+  '''Tells whether a room had events redacted, now or by a run whose purge failed'''
+  return keys_exist(target, room_id, 'events') or keys_exist(target, room_id, 'bulk') or keys_exist(target, room_id, 'pending')
+
+
+def purge_rooms(target, headers, workers):
+  '''Purges events older than each room's cutoff on the database, keeping
+  at most workers purges running on the server at once'''
+  rooms = []
+  for room_id in target.keys():
+    if purge_candidate(target, room_id) == False:
+      continue
+    # Keep the events that could not be redacted so that the next run retries them
+    if len(target[room_id].get('failed', [])) > 0:
+      print('Not purging room ' + room_id + ': some events could not be redacted')
+      continue
+    rooms.append(room_id)
+  results = client.run_jobs(rooms, lambda room_id: start_purge(headers, room_id, target[room_id]['until']),
+                            lambda purge_id: purge_status(headers, purge_id), workers, stop=stopping)
+  client.summarise_jobs('Purge', results)
+  return results
+
+
+def start_purge(headers, room_id, until):
+  '''Starts purging a room's history and returns the purge_id'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/purge_history/' + room_id
+  json = {'delete_local_events': True, 'purge_up_to_ts': until}
+  request = client.post(url, headers=headers, json=json)
+  response = request.json()
+  print('Purging room ' + room_id + ': ' + str(request))
+  return response.get('purge_id')
+
+
+def purge_status(headers, purge_id):
+  '''Gets the status of a purge: active, complete or failed'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/purge_history_status/' + purge_id
+  return client.job_status(headers, url)
+
+
+def media_stats(conn, until, size_gt):
+  '''Returns the number and total bytes of local media files uploaded before
+  until that are larger than size_gt bytes'''
+  sql = 'SELECT COUNT(*), COALESCE(SUM(media_length), 0) FROM local_media_repository \
+        WHERE created_ts < ? AND media_length > ?;'
+  return conn.execute(sql, (until, size_gt)).fetchone()
+
+
+def media_windows(conn, until, size_gt, window_hours):
+  '''Splits the time from the least recently used local media file up to until
+  into windows of window_hours and returns where each of them ends'''
+  # before_ts applies to when media was last accessed, or uploaded if never
+  sql = 'SELECT MIN(COALESCE(last_access_ts, created_ts)) FROM local_media_repository \
+        WHERE created_ts < ? AND COALESCE(last_access_ts, created_ts) < ? AND media_length > ?;'
+  oldest = conn.execute(sql, (until, until, size_gt)).fetchone()[0]
+  if oldest == None:
+    return []
+  step = int(window_hours * 3600000)
+  return list(range(oldest + step, until, step)) + [until]
+
+
+def delete_media(headers, before_ts, size_gt):
+  '''Deletes local media last accessed before before_ts, except profile pictures,
+  and returns how many files were deleted'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/media/' + core.server_name + '/delete'
+  params = {'before_ts': before_ts, 'size_gt': size_gt, 'keep_profiles': 'true'}
+  request = client.post(url, headers=headers, params=params, json={})
+  print('Deleting media before ' + str(before_ts) + ': ' + str(request))
+  if request.ok == False:
+    return 0
+  return request.json().get('total', 0)
+
+
+def purge_media(conn, headers, until, size_gt, window_hours):
+  '''Deletes local media older than until, one window of window_hours at a time
+  so that no request runs for too long. Returns (files, bytes) reclaimed'''
+  files_before, bytes_before = media_stats(conn, until, size_gt)
+  files = 0
+  for before_ts in media_windows(conn, until, size_gt, window_hours):
+    if stopping.is_set():
+      break
+    files = files + delete_media(headers, before_ts, size_gt)
+  # Synapse doesn't say how big the files it deleted were, so they were counted beforehand
+  files_after, bytes_after = media_stats(conn, until, size_gt)
+  reclaimed = bytes_before - bytes_after
+  print('Media: ' + str(files) + ' files deleted, ' + str(round(reclaimed / 1048576, 1)) + ' MiB reclaimed')
+  synapse_metrics.count('media_files', files)
+  synapse_metrics.count('media_bytes', reclaimed)
+  return files, reclaimed
+
+
+def database_bytes():
+  '''Returns the size of the database and its write-ahead log'''
+  size = os.path.getsize(database)
+  if os.path.exists(database + '-wal'):
+    size = size + os.path.getsize(database + '-wal')
+  return size
+
+
+def is_idle(conn, seconds, max_writes):
+  '''Watches the database for seconds and tells whether Synapse committed
+  to it at most max_writes times meanwhile'''
+  writes = 0
+  version = conn.execute('PRAGMA data_version;').fetchone()[0]
+  deadline = time.monotonic() + seconds
+  while time.monotonic() < deadline:
+    time.sleep(0.1)
+    current = conn.execute('PRAGMA data_version;').fetchone()[0]
+    if current != version:
+      writes = writes + 1
+      version = current
+  return writes <= max_writes
+
+
+def maintain(vacuum, pages, idle_seconds, max_writes):
+  '''Refreshes the query planner statistics, truncates the write-ahead log and
+  gives free pages back to the filesystem, pages at a time, or all at once with
+  a full VACUUM if vacuum is set. Returns a report, or None if Synapse was busy'''
+  # This is the only time the database is opened for writing
+  conn = sqlite3.connect(database, timeout=busy_timeout, isolation_level=None)
+  try:
+    if is_idle(conn, idle_seconds, max_writes) == False:
+      print('Maintenance: skipped, the database is busy')
+      return None
+    started = time.monotonic()
+    report = {'bytes_before': database_bytes(), 'pages_before': conn.execute('PRAGMA page_count;').fetchone()[0],
+              'free_pages': conn.execute('PRAGMA freelist_count;').fetchone()[0]}
+    # Samples indexes rather than reading them whole, which keeps ANALYZE short
+    conn.execute('PRAGMA analysis_limit = 1000;')
+    conn.execute('ANALYZE;')
+    if vacuum == True:
+      # Switching to incremental auto_vacuum only takes effect with a VACUUM,
+      # and lets later runs give free pages back in steps
+      conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+      conn.execute('VACUUM;')
+    elif conn.execute('PRAGMA auto_vacuum;').fetchone()[0] == 2:
+      free = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+      while free > 0 and stopping.is_set() == False:
+        conn.execute('PRAGMA incremental_vacuum(' + str(int(pages)) + ');').fetchall()
+        free = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+    else:
+      print('Maintenance: auto_vacuum is not incremental, run once with --vacuum to give free pages back')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    # VACUUM also frees the pages it empties by packing rows together, which never show up as free
+    report['pages_after'] = conn.execute('PRAGMA page_count;').fetchone()[0]
+    report['freed_pages'] = report['pages_before'] - report['pages_after']
+    report['bytes_after'] = database_bytes()
+    report['seconds'] = round(time.monotonic() - started, 1)
+  except sqlite3.OperationalError as e:
+    # Synapse kept the database locked for longer than busy_timeout
+    print('Maintenance: stopped, ' + str(e))
+    return None
+  finally:
+    conn.close()
+  print('Maintenance: ' + str(report['freed_pages']) + ' pages freed, ' + str(report['bytes_before']) + ' bytes before, ' +
+        str(report['bytes_after']) + ' bytes after, in ' + str(report['seconds']) + 's')
+  synapse_metrics.count('maintenance_freed_pages', report['freed_pages'])
+  synapse_metrics.count('maintenance_reclaimed_bytes', report['bytes_before'] - report['bytes_after'])
+  return report
+
+
+def measure_latency(headers, samples=5):
+  '''Measures the average time in seconds of a cheap request to Synapse'''
+  url = str(core.public_baseurl) + '/_matrix/client/r0/account/whoami'
+  started = time.monotonic()
+  for sample in range(samples):
+    client.get(url, headers=headers)
+  return (time.monotonic() - started) / samples
+
+
+def plan_run(conn, target, headers, until, workers, purges, redaction):
+  '''Works out what a run would do, and roughly how long it would
+  take, without redacting, purging or deleting anything'''
+  senders = {}
+  if redaction == 'admin':
+    senders = get_senders(conn)
+    load_bulk_senders(conn, senders)
+  rooms = {}
+  for room_id, room_events, skipped in get_events(conn):
+    rooms[room_id] = {'until': target[room_id]['until'], 'events': len(room_events), 'skipped': skipped, 'bulk': 0}
+  for sender in senders.keys():
+    for room_id, (expired, events) in senders[sender].items():
+      empty = {'until': target[room_id]['until'], 'events': 0, 'skipped': 0, 'bulk': 0}
+      rooms.setdefault(room_id, empty)['bulk'] += expired
+  # Rooms redacted by a run whose purge failed are purged again
+  for room_id in target.keys():
+    if keys_exist(target, room_id, 'pending'):
+      rooms.setdefault(room_id, {'until': target[room_id]['until'], 'events': 0, 'skipped': 0, 'bulk': 0})
+  redactions = 0
+  largest = 0
+  no_token = 0
+  for room_id in rooms.keys():
+    rooms[room_id]['token'] = keys_exist(target, room_id, 'token')
+    # Rooms without a member token can't be redacted one event at a time
+    if rooms[room_id]['events'] > 0 and rooms[room_id]['token'] == False:
+      no_token = no_token + 1
+      continue
+    redactions = redactions + rooms[room_id]['events']
+    largest = max(largest, rooms[room_id]['events'])
+  purge = len(rooms) - no_token
+  # Found like the run does, since target has lost the rooms that retention rules keep forever
+  abandoned = len(core.find_abandoned(headers))
+  latency = measure_latency(headers)
+  # Rooms are redacted in parallel but each room's events one after another
+  seconds = max(redactions / workers, largest) * latency
+  seconds = seconds + len(senders) / workers * latency + purge / purges * latency + abandoned * latency
+  plan = {}
+  plan['until'] = until
+  plan['rooms'] = rooms
+  plan['redactions'] = redactions
+  plan['skipped'] = sum([room['skipped'] for room in rooms.values()])
+  plan['bulk_jobs'] = len(senders)
+  plan['bulk_events'] = sum([room['bulk'] for room in rooms.values()])
+  plan['no_token'] = no_token
+  plan['purges'] = purge
+  plan['abandoned'] = abandoned
+  plan['api_calls'] = redactions + len(senders) + purge + abandoned
+  plan['latency_ms'] = round(latency * 1000, 1)
+  plan['estimated_seconds'] = round(seconds)
+  return plan
+
+
+def print_plan(plan, output):
+  '''Prints a plan as compact JSON or as a table'''
+  if output == 'json':
+    print(json.dumps(plan, separators=(',', ':')))
+    return
+  print('{:<50} {:>14} {:>10} {:>10} {:>10} {:>6}'.format('room_id', 'until', 'events', 'skipped', 'bulk', 'token'))
+  for room_id, room in plan['rooms'].items():
+    print('{:<50} {:>14} {:>10} {:>10} {:>10} {:>6}'.format(room_id, room['until'], room['events'], room['skipped'],
+                                                           room['bulk'], str(room['token'])))
+  for key in plan.keys():
+    if key != 'rooms':
+      print('{:<20} {}'.format(key, plan[key]))
+  print('Estimated time excludes the time Synapse spends on purges and bulk jobs')
+
+
+def sweep(conn, state, target, headers, workers, purges, redaction):
+  '''Redacts and purges the expired messages of the rooms loaded into conn.
+  Returns target and the results of the purges'''
+  # Redacts senders with only expired messages in a room in bulk
+  if redaction == 'admin':
+    with synapse_metrics.phase('redact_senders'):
+      target = redact_senders(conn, state, target, headers, workers)
+  # Streams events older than each room's cutoff, per room. Time spent
+  # querying them is recorded as get_events and is part of redact_rooms too
+  events = synapse_metrics.timed('get_events', get_events(conn))
+  # Redact events older than 'until' per room , using a member's token
+  with synapse_metrics.phase('redact_rooms'):
+    target = redact_rooms(target, events, workers, state)
+  # Ends any transaction left open so that Synapse can checkpoint its WAL
+  conn.commit()
+  # Rooms that were not reached can't be told apart from rooms with
+  # nothing to redact, so none of them are advanced or purged. Those
+  # already redacted are pending and get purged by the next run
+  if stopping.is_set():
+    return target, []
+  target = advance_watermarks(state, target)
+  with synapse_metrics.phase('purge_rooms'):
+    purged = purge_rooms(target, headers, purges)
+  # Only rooms whose purge completed are done with
+  target = advance_purged(state, target, purged)
+  return target, purged
+
+
+def sweep_slice(room_id, slices):
+  '''Returns the slice of the day a room is swept in, which stays the same across restarts'''
+  return zlib.crc32(room_id.encode('utf-8')) % slices
+
+
+def stop(signum, frame):
+  '''Asks the daemon to finish what it is doing and exit'''
+  print('Stopping on signal ' + str(signum))
+  stopping.set()
+
+
+def run_daemon(config, admin, passw, hours, rules, workers, purges, redaction, maintenance, vacuum):
+  '''Sweeps a slice of the rooms at a time, sweep_slices times a day, so that
+  every room is swept once a day and the load on Synapse is spread evenly.
+  Slices missed while a sweep overran are swept before sleeping again.
+  The session, token and database connection are kept between sweeps'''
+  slices = config.get('sweep_slices', 24)
+  slice_seconds = 86400 / slices
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  # Output goes to a journal or log file rather than a terminal
+  sys.stdout.reconfigure(line_buffering=True)
+  state = open_state(config.get('state', 'state.db'))
+  conn = connect_database()
+  token = None
+  headers = None
+  # Slices are numbered from the epoch, so that the day they fall in is number // slices
+  last = int(time.time() // slice_seconds) - 1
+  # The day the once a day tasks last ran, which they do on the first sweep after starting too
+  day = None
+  while stopping.is_set() == False:
+    current = int(time.time() // slice_seconds)
+    if last >= current:
+      # Sleeps until the next slice starts, waking up at once on SIGTERM
+      stopping.wait(slice_seconds - time.time() % slice_seconds)
+      continue
+    # Every room comes up once in the last day of slices, so older ones are not swept twice
+    number = max(last + 1, current - slices + 1)
+    if number < current:
+      print('Behind schedule: ' + str(current - number) + ' slices to sweep after this one')
+    last = number
+    n = number % slices
+    synapse_metrics.reset()
+    success = False
+    try:
+      # The token is only renewed when Synapse no longer accepts it
+      if token == None or client.whoami(core.public_baseurl, token) == False:
+        with synapse_metrics.phase('log_in'):
+          token = core.log_in(admin, passw)
+        headers = {'Authorization': 'Bearer '+ token, 'Content-Type': 'application/json'}
+      with synapse_metrics.phase('get_rooms'):
+        rooms = get_rooms(headers, {})
+        target = {room_id: room for room_id, room in rooms.items() if sweep_slice(room_id, slices) == n}
+      now = int(datetime.now().timestamp() * 1000)
+      target = resolve_cutoffs(target, rules, hours, now)
+      with synapse_metrics.phase('get_tokens'):
+        load_targets(conn, target, state)
+        target = get_tokens(conn, target)
+      print('Sweeping slice ' + str(n + 1) + ' of ' + str(slices) + ': ' + str(len(target)) + ' rooms')
+      target, purged = sweep(conn, state, target, headers, workers, purges, redaction)
+      deleted = []
+      # Abandoned rooms are deleted once a day, along with its first sweep
+      if day != number // slices and stopping.is_set() == False:
+        with synapse_metrics.phase('delete_abandoned'):
+          deleted = core.delete_abandoned(headers, purges, stop=stopping)
+        # So is old media
+        if config.get('media_retention', False) == True and stopping.is_set() == False:
+          until = int(datetime.now().timestamp() * 1000) - hours * 3600000
+          with synapse_metrics.phase('purge_media'):
+            purge_media(conn, headers, until, config.get('media_size_gt', 0), config.get('media_window_hours', 168))
+        # And the database is looked after
+        if maintenance == True and stopping.is_set() == False:
+          with synapse_metrics.phase('maintenance'):
+            maintain(vacuum, config.get('maintenance_pages', 1000), config.get('maintenance_idle_seconds', 5),
+                     config.get('maintenance_max_writes', 0))
+        # Tried again with the next sweep if they were stopped or failed
+        if stopping.is_set() == False:
+          day = number // slices
+      count_items(target, purged, deleted)
+      success = True
+    except (client.RequestException, ValueError, KeyError, sqlite3.Error) as e:
+      # Watermarks keep the progress, so its rooms resume the next time their slice comes round
+      print('Sweep failed: ' + str(e))
+    finally:
+      synapse_metrics.write(config, 'redact-and-purge', success)
+  conn.close()
+  state.close()
+  if headers != None:
+    core.log_out(headers)
+
+
+def count_items(target, purged, deleted):
+  '''Records how many rooms and events the run handled'''
+  synapse_metrics.count('rooms', len(target))
+  for room in target.values():
+    failed = len(room.get('failed', []))
+    synapse_metrics.count('events_skipped', room.get('skipped', 0))
+    synapse_metrics.count('events_bulk', room.get('bulk', 0))
+    # failed holds senders rather than events when a bulk job failed
+    if 'events' in room:
+      synapse_metrics.count('events_redacted', room['events'] - min(failed, room['events']))
+      synapse_metrics.count('events_failed', min(failed, room['events']))
+  for kind, results in (('purges', purged), ('deletions', deleted)):
+    complete = len([result for result in results if result[1] == 'complete'])
+    synapse_metrics.count(kind + '_complete', complete)
+    synapse_metrics.count(kind + '_failed', len(results) - complete)
+
+
+# FROM: https://stackoverflow.com/questions/43491287/elegant-way-to-check-if-a-nested-key-exists-in-a-dict
+def keys_exist(element, *keys):
+  '''Check if *keys (nested) exists in `element` (dict).'''
+  if not isinstance(element, dict):
+    raise AttributeError('keys_exists() expects dict as first argument.')
+  if len(keys) == 0:
+    raise AttributeError('keys_exists() expects at least two arguments, one given.')
+  _element = element
+  for key in keys:
+    try:
+      _element = _element[key]
+    except KeyError:
+      return False
+  return True
+
+
+def main(argv=None, prog=None):
+  '''Redacts and purges messages older than rp_hours, and
+  deletes rooms nobody is a member of anymore'''
+  parser = argparse.ArgumentParser(prog=prog, description='Synapse message retention.', add_help=False)
+  optional = parser.add_argument_group('Optional arguments')
+  optional.add_argument('--plan', help='show what a run would do and how long it would take, without doing it', action='store_true')
+  optional.add_argument('--format', help='output format of the plan', choices=['table', 'json'], default='table')
+  optional.add_argument('--daemon', help='keep running and sweep a slice of the rooms at a time, sweep_slices times a day', action='store_true')
+  optional.add_argument('--maintenance', help='analyze, checkpoint and incrementally vacuum the database afterwards, if it is idle', action='store_true')
+  optional.add_argument('--vacuum', help='run a full VACUUM during maintenance, implies --maintenance', action='store_true')
+  optional.add_argument('-h', '--help', help='show this help message and exit.', action='help')
+  args = parser.parse_args(argv)
+
+  # Read config.json
+  config = core.open_config(edit_first=True)
+  core.configure(config)
+  # Fully qualified users take the form @user:server_name
+  admin = core.fq_user(config['admin'], core.server_name)
+  passw = config['password']
+  
+  global database
+  database = config['database']
+  global busy_timeout
+  busy_timeout = config.get('busy_timeout', 5)
+  global scan_chunk
+  scan_chunk = config.get('scan_chunk', 5000)
+  global scan_pause
+  scan_pause = config.get('scan_pause', 0)
+
+  hours = config['rp_hours']
+  workers = config.get('concurrency', 4)
+  purges = config.get('purge_concurrency', 2)
+  redaction = config.get('redaction', 'events')
+  rules = config.get('retention', [])
+  maintenance = args.maintenance or args.vacuum
+  error = check_rules(rules)
+  if error != None:
+    print(error)
+    exit()
+  if args.daemon == True:
+    run_daemon(config, admin, passw, hours, rules, workers, purges, redaction, maintenance, args.vacuum)
+    return
+  state = open_state(config.get('state', 'state.db'))
+  now = int(datetime.now().timestamp() * 1000)
+  until = now - hours * 3600000
+
+  success = False
+  try:
+    with synapse_metrics.phase('log_in'):
+      token = core.log_in(admin, passw)
+    headers = {'Authorization': 'Bearer '+ token, 'Content-Type': 'application/json'}
+    target = {}
+    ######### NOTE #########
+    # target will be a nested dictionary with a count of events like this
+    # {
+    #   $room_id: 
+    #             {
+    #               'joined_members': $count,
+    #               'canonical_alias': $alias,
+    #               'room_type': $type,
+    #               'until': $cutoff,
+    #               'token': $token,
+    #               'events': $count,
+    #               'skipped': $count,
+    #               'bulk': $count,
+    #               'failed': [$event_ids or $senders]
+    #             }
+    # }
+    #######################
+    # Gets rooms on the server
+    with synapse_metrics.phase('get_rooms'):
+      target = get_rooms(headers, target)
+    # Every room gets its own cutoff from the retention rules
+    target = resolve_cutoffs(target, rules, hours, now)
+    # Only events past each room's watermark are looked at
+    with synapse_metrics.phase('get_tokens'):
+      conn = open_database(target, state)
+      # Gets a member's token per room 
+      target = get_tokens(conn, target)
+    # Works out what would be done and stops there
+    if args.plan == True:
+      plan = plan_run(conn, target, headers, until, workers, purges, redaction)
+      conn.close()
+      state.close()
+      core.log_out(headers)
+      print_plan(plan, args.format)
+      return
+    # We have everything we need to start cleaning up
+    # It might be a good idea to run with --plan first to see what would be redacted and purged
+    target, purged = sweep(conn, state, target, headers, workers, purges, redaction)
+    state.close()
+    # Delete and purge all rooms with "joined_members": 0
+    with synapse_metrics.phase('delete_abandoned'):
+      deleted = core.delete_abandoned(headers, purges, stop=stopping)
+    # Delete media uploaded before rp_hours
+    if config.get('media_retention', False) == True:
+      with synapse_metrics.phase('purge_media'):
+        purge_media(conn, headers, until, config.get('media_size_gt', 0), config.get('media_window_hours', 168))
+    conn.close()
+    core.log_out(headers)
+    # Purges and deletions leave free pages and stale statistics behind
+    if maintenance == True:
+      with synapse_metrics.phase('maintenance'):
+        maintain(args.vacuum, config.get('maintenance_pages', 1000), config.get('maintenance_idle_seconds', 5),
+                 config.get('maintenance_max_writes', 0))
+    count_items(target, purged, deleted)
+    success = True
+  finally:
+    # A plan is not a run, so it leaves the last run's metrics alone
+    if args.plan == False:
+      synapse_metrics.write(config, 'redact-and-purge', success)
+
+if __name__ == '__main__':
+    main()
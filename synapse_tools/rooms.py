@@ -0,0 +1,90 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''synapse-tools rooms: lists, queries and deletes Synapse rooms'''
+
+import argparse
+import json
+import sys
+from synapse_tools import core
+from synapse_tools import index as synapse_index
+
+
+def refresh_index(headers, path):
+  '''Resyncs the local rooms index with the rooms on the server'''
+  index = synapse_index.open_index(path)
+  added, changed, removed = synapse_index.refresh(index, 'rooms', core.iter_rooms(headers))
+  index.close()
+  print('Rooms index: ' + str(added) + ' added, ' + str(changed) + ' changed, ' + str(removed) + ' removed', file=sys.stderr)
+
+
+def query_index(path, name, members_lt):
+  '''Lists rooms from the local index without asking the server'''
+  index = synapse_index.open_index(path)
+  print(synapse_index.age(index, 'rooms'), file=sys.stderr)
+  for room in synapse_index.query_rooms(index, name, members_lt):
+    print(json.dumps(room))
+  index.close()
+
+
+def main(argv=None, prog=None):
+  '''Provides a command line tool to manage rooms
+  in Synapse - Matrix.org’s reference server
+  making use of its administration APIs'''
+  parser = argparse.ArgumentParser(prog=prog, description='Synapse server room admin.', add_help=False)
+  required = parser.add_argument_group('Action arguments')
+  exclusive = required.add_mutually_exclusive_group()
+  exclusive.add_argument('-d', metavar='room_id', help='delete room', type=str)
+  exclusive.add_argument('-l', help='list all rooms', action='store_true')
+  exclusive.add_argument('-p', help='delete and purge rooms with "joined_members": 0', action='store_true')
+  exclusive.add_argument('-q', help='query rooms in the local index', action='store_true')
+  optional = parser.add_argument_group('Optional arguments')
+  core.add_server_arguments(optional)
+  optional.add_argument('-t', help='output all rooms list to NDJSON txt file too', action='store_true')
+  optional.add_argument('--by', help='with -p, count joined_members or only joined_local_members', choices=['joined_members', 'joined_local_members'], default='joined_members')
+  optional.add_argument('--min-age', help='with -p, only rooms created at least this many hours ago', type=float)
+  optional.add_argument('--refresh', help='resync the local index with the server, before -q if given', action='store_true')
+  optional.add_argument('--name', help='with -q, rooms whose name or alias contains this text', type=str)
+  optional.add_argument('--members-lt', help='with -q, rooms with fewer joined members than this', type=int)
+  optional.add_argument('-h', '--help', help='show this help message and exit.', action='help')
+  args = parser.parse_args(argv)
+
+  # Read config.json
+  config = core.open_config()
+  workers = config.get('purge_concurrency', 2)
+  index = config.get('index', 'index.db')
+
+  # Queries to the local index don't need the server
+  if args.q and args.refresh == False:
+    query_index(index, args.name, args.members_lt)
+    exit()
+
+  core.configure(config)
+  admin = core.override(config, args)
+  # Log in to obtain a valid admin token, keeping stdout for the rooms
+  token = core.log_in(admin, file=sys.stderr)
+  # Token is added to the request headers
+  headers = {'Authorization': 'Bearer '+ token, 'Content-Type': 'application/json'}
+  # Resyncs the local index
+  if args.refresh:
+    refresh_index(headers, index)
+  # Deletes and purges room_id
+  if args.d:
+    core.delete_rooms(headers, [args.d], workers)
+  # List all rooms
+  elif args.l:
+    for room in core.list_rooms(headers, args.t):
+      print(json.dumps(room))
+  elif args.p:
+    core.delete_abandoned(headers, workers, args.by, args.min_age)
+  elif args.q:
+    query_index(index, args.name, args.members_lt)
+
+  # Log out to invalidate the token
+  core.log_out(headers, file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
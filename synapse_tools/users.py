@@ -0,0 +1,565 @@
+# Copyright 2020 Innovara Ltd
+# -*- coding: utf-8 -*-
+# Licensed under the GNU General Public License, version 3. This file may not be
+# copied, modified, or distributed except according to those terms.
+
+'''synapse-tools users: manages Synapse users through the admin API'''
+
+import argparse
+import collections
+import getpass
+import json
+import os
+import csv
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from synapse_tools import client
+from synapse_tools import core
+from synapse_tools import index as synapse_index
+
+def get(headers, url):
+  '''Gets url and prints json response'''
+  request = client.get(url, headers=headers)
+  response = request.json()
+  print(json.dumps(response, indent=4))
+
+
+def post(headers, url, json):
+  '''Posts to url and prints response'''
+  request = client.post(url, headers=headers, json=json)
+  print(request)
+
+
+def put(headers, url, json):
+  '''Puts to url and prints response'''
+  request = client.put(url, headers=headers, json=json)
+  print(request)
+
+
+def log_out_a(headers):
+  '''Logs out admin user from all devices invalidating
+  all access tokens including the current one-time'''
+  url = str(core.public_baseurl) + '/_matrix/client/r0/logout/all'
+  request = client.post(url, headers=headers)
+  print('Log out all: ' + str(request))
+  if core.token_cache != '':
+    client.cache_token(core.token_cache, core.public_baseurl, admin, None)
+  exit()
+
+
+def check_admin(headers, user):
+  '''Checks if a Synapse user is an admin'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/users/'+ user +'/admin'
+  get(headers, url)
+
+
+def create_user(headers, user):
+  '''Creates a Synapse user'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  passw = getpass.getpass('Please enter password for ' + user + ': ')
+  json = {'password': passw}
+  put(headers, url, json)
+
+
+def deactivate_user(headers, user):
+  '''Deactivates a Synapse user'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/deactivate/' + user
+  json = {'erase': True}
+  post(headers, url, json)
+
+
+def get_users_page(headers, params, start):
+  '''Gets a page of Synapse users starting at next_token start'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users'
+  params = dict(params)
+  if start != None:
+    params['from'] = start
+  request = client.get(url, headers=headers, params=params)
+  return request.json()
+
+
+def iter_users(headers, params, prefetch=True):
+  '''Yields every Synapse user following next_token'''
+  return core.paginate(lambda start: get_users_page(headers, params, start), 'next_token', 'users', prefetch)
+
+
+def write_users(users, fields, output):
+  '''Streams users to stdout as NDJSON or CSV, keeping only fields if given'''
+  writer = None
+  for user in users:
+    if fields != None:
+      user = {field: user.get(field) for field in fields}
+    if output == 'csv':
+      # Without --fields the columns are those of the first user
+      if writer == None:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(user.keys()), extrasaction='ignore')
+        writer.writeheader()
+      writer.writerow(user)
+    else:
+      print(json.dumps(user))
+
+
+def list_users(headers, params, fields, output):
+  '''Streams all users matching params to stdout'''
+  write_users(iter_users(headers, params), fields, output)
+
+
+def list_a_users(headers, fields, output, limit):
+  '''Lists all Synapse users, including deactivated and guests'''
+  params = {'deactivated': 'true', 'guests': 'true', 'limit': limit}
+  list_users(headers, params, fields, output)
+
+
+def list_c_users(headers, fields, output, limit):
+  '''Lists current Synapse users'''
+  params = {'limit': limit}
+  list_users(headers, params, fields, output)
+
+
+def list_user(headers, user):
+  '''Queries a Synapse user'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  get(headers, url)
+
+
+def make_admin(headers, user):
+  '''Makes a Synapse user an admin'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/'+ user
+  json = {'admin': True}
+  put(headers, url, json)
+
+
+def reset_pass(headers, user):
+  '''Resets a Synapse user's password'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  passw = getpass.getpass('Please enter new password for ' + user + ': ')
+  json = {'password': passw, 'logout_devices': True}
+  put(headers, url, json)
+
+
+def reactivate_user(headers, user):
+  '''Reactivates a Synapse user'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  passw = getpass.getpass('Please enter new password for ' + user + ': ')
+  json = {'password': passw, 'deactivated': False}
+  put(headers, url, json)
+
+
+def make_regular(headers, user):
+  '''Makes an admin Synapse user a regular user'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  json = {'admin': False}
+  put(headers, url, json)
+
+
+def refresh_index(headers, path, limit):
+  '''Resyncs the local users index with all the users on the server'''
+  index = synapse_index.open_index(path)
+  params = {'deactivated': 'true', 'guests': 'true', 'limit': limit}
+  added, changed, removed = synapse_index.refresh(index, 'users', iter_users(headers, params))
+  index.close()
+  print('Users index: ' + str(added) + ' added, ' + str(changed) + ' changed, ' + str(removed) + ' removed', file=sys.stderr)
+
+
+def query_index(path, args, fields):
+  '''Lists users from the local index without asking the server'''
+  seen_before = None
+  if args.seen_before != None:
+    seen_before = int((time.time() - args.seen_before * 86400) * 1000)
+  index = synapse_index.open_index(path)
+  print(synapse_index.age(index, 'users'), file=sys.stderr)
+  users = synapse_index.query_users(index, args.name, args.admins, args.deactivated, seen_before)
+  write_users(users, fields, args.format)
+  index.close()
+
+
+def read_batch(path):
+  '''Reads batch actions from a CSV file with an action,user,password
+  header or from a NDJSON file with one such object per line'''
+  with open(path, 'r', encoding='utf-8') as in_file:
+    first = in_file.read(1)
+    in_file.seek(0)
+    if first == '{':
+      rows = [json.loads(line) for line in in_file if line.strip() != '']
+    else:
+      rows = list(csv.DictReader(in_file))
+  return rows
+
+
+def batch_request(action, user, passw):
+  '''Returns the method, url and json of a batch action'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user
+  if action == 'deactivate':
+    return 'POST', str(core.public_baseurl) + '/_synapse/admin/v1/deactivate/' + user, {'erase': True}
+  if action == 'admin':
+    return 'PUT', url, {'admin': True}
+  if action == 'regular':
+    return 'PUT', url, {'admin': False}
+  # The rest of the actions need a password
+  if passw == None or passw == '':
+    raise ValueError('missing password')
+  if action == 'create':
+    return 'PUT', url, {'password': passw}
+  if action == 'reset':
+    return 'PUT', url, {'password': passw, 'logout_devices': True}
+  if action == 'reactivate':
+    return 'PUT', url, {'password': passw, 'deactivated': False}
+  raise ValueError('unknown action ' + str(action))
+
+
+def run_batch_row(headers, line, row):
+  '''Runs a batch action and returns its result for the report'''
+  action = row.get('action')
+  user = str(row.get('user'))
+  if user.startswith('@') == False:
+    user = core.fq_user(user, core.server_name)
+  result = {'line': line, 'action': action, 'user': user, 'status': '', 'latency_ms': '', 'error': ''}
+  started = time.monotonic()
+  try:
+    method, url, json = batch_request(action, user, row.get('password'))
+    request = client.request(method, url, headers=headers, json=json)
+    result['status'] = request.status_code
+    if request.ok == False:
+      result['error'] = request.text
+  except (ValueError, client.RequestException) as error:
+    result['error'] = str(error)
+  result['latency_ms'] = round((time.monotonic() - started) * 1000)
+  return result
+
+
+def run_batch(headers, path, workers, report):
+  '''Runs the actions in a batch file over one admin session, with a
+  pool of workers, and writes a per-row result report as CSV'''
+  rows = read_batch(path)
+  fieldnames = ['line', 'action', 'user', 'status', 'latency_ms', 'error']
+  failed = 0
+  with ThreadPoolExecutor(max_workers=workers) as executor, \
+       open(report, 'w', encoding='utf-8', newline='') as out_file:
+    writer = csv.DictWriter(out_file, fieldnames=fieldnames)
+    writer.writeheader()
+    results = executor.map(run_batch_row, [headers] * len(rows), range(1, len(rows) + 1), rows)
+    for result in results:
+      writer.writerow(result)
+      if result['error'] != '':
+        failed = failed + 1
+  print('Batch: ' + str(len(rows) - failed) + ' ok, ' + str(failed) + ' failed. Report in ' + report)
+
+
+def get_json(headers, url):
+  '''Gets url and returns its json response, raising ValueError if it fails'''
+  request = client.get(url, headers=headers)
+  if request.ok == False:
+    raise ValueError(url.replace(str(core.public_baseurl), '') + ': ' + str(request.status_code))
+  return request.json()
+
+
+def get_devices(headers, user):
+  '''Returns a user's devices'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user + '/devices'
+  return get_json(headers, url).get('devices', [])
+
+
+def last_connection(headers, user):
+  '''Returns when any session of a user was last seen according to whois, or None'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v1/whois/' + user
+  last_seen = None
+  for device in get_json(headers, url).get('devices', {}).values():
+    for session in device.get('sessions', []):
+      for connection in session.get('connections', []):
+        if connection.get('last_seen') != None and (last_seen == None or connection['last_seen'] > last_seen):
+          last_seen = connection['last_seen']
+  return last_seen
+
+
+def current_device(headers):
+  '''Returns the device of the admin session, which is never pruned'''
+  url = str(core.public_baseurl) + '/_matrix/client/r0/account/whoami'
+  return get_json(headers, url).get('device_id')
+
+
+def delete_devices(headers, user, devices):
+  '''Deletes devices of a user, and their access tokens, in one request'''
+  url = str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user + '/delete_devices'
+  request = client.post(url, headers=headers, json={'devices': devices})
+  if request.ok == False:
+    raise ValueError(url.replace(str(core.public_baseurl), '') + ': ' + str(request.status_code))
+
+
+def audit_user(headers, user, now, inactive_days, stale_days):
+  '''Merges a user's details, devices and sessions into an audit row'''
+  row = {'name': user['name'], 'admin': bool(user.get('admin')), 'user_type': user.get('user_type'),
+         'appservice_id': None, 'creation_ts': user.get('creation_ts'), 'last_seen_ts': None,
+         'days_inactive': None, 'inactive': False, 'devices': 0, 'stale_devices': 0, 'error': ''}
+  try:
+    details = get_json(headers, str(core.public_baseurl) + '/_synapse/admin/v2/users/' + user['name'])
+    devices = get_devices(headers, user['name'])
+    whois = last_connection(headers, user['name'])
+  except (ValueError, client.RequestException) as error:
+    row['error'] = str(error)
+    return row
+  row['admin'] = bool(details.get('admin', user.get('admin')))
+  row['user_type'] = details.get('user_type', user.get('user_type'))
+  row['appservice_id'] = details.get('appservice_id')
+  # The users list only has last_seen_ts on recent Synapse versions
+  seen = [ts for ts in [user.get('last_seen_ts'), whois] + [device.get('last_seen_ts') for device in devices]
+          if ts != None]
+  if len(seen) > 0:
+    row['last_seen_ts'] = max(seen)
+  # Users never seen are measured from when they registered
+  since = row['last_seen_ts'] if row['last_seen_ts'] != None else row['creation_ts']
+  if since != None:
+    row['days_inactive'] = int((now - since) / 86400000)
+    row['inactive'] = now - since >= inactive_days * 86400000
+  row['devices'] = len(devices)
+  stale_before = now - stale_days * 86400000
+  row['stale_devices'] = len([device for device in devices
+                              if device.get('last_seen_ts') == None or device['last_seen_ts'] < stale_before])
+  return row
+
+
+def map_users(function, headers, users, workers, *args):
+  '''Calls function(headers, user, *args) for users with a pool of workers,
+  yielding the results in order'''
+  pending = collections.deque()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for user in users:
+      pending.append(executor.submit(function, headers, user, *args))
+      # Only a few users are queued ahead of the workers, so audits and
+      # pruning stream instead of holding every user of the server in memory
+      if len(pending) >= workers * 2:
+        yield pending.popleft().result()
+    while len(pending) > 0:
+      yield pending.popleft().result()
+
+
+def audit(headers, fields, output, limit, workers, inactive_days, stale_days, batch):
+  '''Streams the current users that are inactive, have stale devices or are
+  admins, and optionally writes a batch file deactivating the inactive ones'''
+  totals = {'users': 0, 'inactive': 0, 'stale_devices': 0, 'admins': 0, 'errors': 0, 'selected': 0}
+  batch_file = None
+  if batch != None:
+    batch_file = open(batch, 'w', encoding='utf-8')
+
+  def report(rows):
+    for row in rows:
+      totals['users'] = totals['users'] + 1
+      totals['inactive'] = totals['inactive'] + int(row['inactive'])
+      totals['stale_devices'] = totals['stale_devices'] + row['stale_devices']
+      totals['admins'] = totals['admins'] + int(row['admin'])
+      totals['errors'] = totals['errors'] + int(row['error'] != '')
+      # Admins, bots and appservice users are never selected for deactivation
+      if batch_file != None and row['inactive'] and row['admin'] == False and row['user_type'] == None \
+         and row['appservice_id'] == None:
+        batch_file.write(json.dumps({'action': 'deactivate', 'user': row['name']}) + '\n')
+        totals['selected'] = totals['selected'] + 1
+      if row['inactive'] or row['stale_devices'] > 0 or row['admin'] or row['error'] != '':
+        yield row
+
+  now = int(time.time() * 1000)
+  try:
+    users = iter_users(headers, {'limit': limit})
+    write_users(report(map_users(audit_user, headers, users, workers, now, inactive_days, stale_days)), fields, output)
+  finally:
+    if batch_file != None:
+      batch_file.close()
+  print('Audit: ' + str(totals['users']) + ' users, ' + str(totals['inactive']) + ' inactive, ' +
+        str(totals['stale_devices']) + ' stale devices, ' + str(totals['admins']) + ' admins, ' +
+        str(totals['errors']) + ' errors', file=sys.stderr)
+  if batch != None:
+    print('Review ' + batch + ' and run it with -b to deactivate ' + str(totals['selected']) + ' users',
+          file=sys.stderr)
+
+
+def prune_user(headers, user, now, stale_days, keep, keep_last):
+  '''Deletes the devices of a user not seen for stale_days, except the device
+  in keep and, if keep_last, the one the user was seen on last'''
+  row = {'name': user['name'], 'devices': 0, 'tool_devices': 0, 'pruned': 0, 'error': ''}
+  try:
+    devices = get_devices(headers, user['name'])
+  except (ValueError, client.RequestException) as error:
+    row['error'] = str(error)
+    return row
+  row['devices'] = len(devices)
+  row['tool_devices'] = len([device for device in devices if device.get('display_name') == client.DEVICE_NAME])
+  devices = sorted(devices, key=lambda device: device.get('last_seen_ts') or 0, reverse=True)
+  if keep_last == True:
+    devices = devices[1:]
+  stale_before = now - stale_days * 86400000
+  stale = [device['device_id'] for device in devices
+           if (user['name'], device['device_id']) != keep
+           and (device.get('last_seen_ts') == None or device['last_seen_ts'] < stale_before)]
+  if len(stale) == 0:
+    return row
+  try:
+    delete_devices(headers, user['name'], stale)
+    row['pruned'] = len(stale)
+  except (ValueError, client.RequestException) as error:
+    row['error'] = str(error)
+  return row
+
+
+def prune_devices(headers, fields, output, limit, workers, stale_days, keep_last):
+  '''Deletes the devices of all users not seen for stale_days, streaming
+  a row for each user that had devices removed or failed'''
+  totals = {'users': 0, 'devices': 0, 'pruned': 0, 'errors': 0}
+  keep = (admin, current_device(headers))
+
+  def report(rows):
+    for row in rows:
+      totals['users'] = totals['users'] + 1
+      totals['devices'] = totals['devices'] + row['devices']
+      totals['pruned'] = totals['pruned'] + row['pruned']
+      totals['errors'] = totals['errors'] + int(row['error'] != '')
+      if row['pruned'] > 0 or row['error'] != '':
+        yield row
+
+  now = int(time.time() * 1000)
+  started = time.monotonic()
+  users = iter_users(headers, {'deactivated': 'true', 'guests': 'true', 'limit': limit})
+  write_users(report(map_users(prune_user, headers, users, workers, now, stale_days, keep, keep_last)), fields, output)
+  print('Prune: ' + str(totals['pruned']) + ' of ' + str(totals['devices']) + ' devices of ' + str(totals['users']) +
+        ' users deleted, ' + str(totals['errors']) + ' errors, in ' + str(round(time.monotonic() - started, 1)) + 's',
+        file=sys.stderr)
+
+
+def main(argv=None, prog=None):
+  '''Provides a command line interface to manage users
+  in Synapse - Matrix.org's reference server
+  making use of its administration APIs'''
+  parser = argparse.ArgumentParser(prog=prog, description='User administration for Synapse.', epilog='Use only the localpart of the user i.e. exampleuser', add_help=False)
+  required = parser.add_argument_group('Action arguments')
+  exclusive = required.add_mutually_exclusive_group()
+  exclusive.add_argument('-uc', metavar='user', help='create new user', type=str)
+  exclusive.add_argument('-ud', metavar='user', help='deactivate user', type=str)
+  exclusive.add_argument('-ur', metavar='user', help='reset user\'s password', type=str)
+  exclusive.add_argument('-ux', metavar='user', help='undo user deactivation', type=str)
+  exclusive.add_argument('-la', help='list all users', action='store_true')
+  exclusive.add_argument('-lc', help='list current users', action='store_true')
+  exclusive.add_argument('-lu', metavar='user', help='list user\'s properties', type=str)
+  exclusive.add_argument('-li', help='list users from the local index', action='store_true')
+  exclusive.add_argument('-am', metavar='user', help='make user administrator', type=str)
+  exclusive.add_argument('-aq', metavar='user', help='query if user is admin', type=str)
+  exclusive.add_argument('-at', help='invalidate all tokens of the admin user', action='store_true')
+  exclusive.add_argument('-ax', metavar='user', help='make an admin user a regular user', type=str)
+  exclusive.add_argument('-ua', help='audit current users for inactivity, stale devices and admins', action='store_true')
+  exclusive.add_argument('-dp', help='delete devices not seen for --stale-days', action='store_true')
+  exclusive.add_argument('-b', metavar='file', help='run the actions in a CSV or NDJSON batch file', type=str)
+  optional = parser.add_argument_group('Optional arguments')
+  core.add_server_arguments(optional)
+  optional.add_argument('--fields', help='comma separated user fields to list i.e. name,admin,deactivated', type=str)
+  optional.add_argument('--format', help='output format of user lists', choices=['ndjson', 'csv'], default='ndjson')
+  optional.add_argument('--limit', help='users per page when listing users', type=int, default=500)
+  optional.add_argument('--workers', help='concurrent requests in batch, audit and prune mode', type=int)
+  optional.add_argument('--report', help='batch result report, defaults to <file>.report.csv', type=str)
+  optional.add_argument('--refresh', help='resync the local index with the server, before -li if given', action='store_true')
+  optional.add_argument('--name', help='with -li, users whose id or display name contains this text', type=str)
+  optional.add_argument('--admins', help='with -li, only admins', action='store_true')
+  optional.add_argument('--deactivated', help='with -li, only deactivated users', action='store_true')
+  optional.add_argument('--seen-before', metavar='DAYS', help='with -li, users not seen for this many days', type=float)
+  optional.add_argument('--inactive-days', metavar='DAYS', help='with -ua, users not seen for this many days are inactive', type=float, default=90)
+  optional.add_argument('--stale-days', metavar='DAYS', help='with -ua and -dp, devices not seen for this many days are stale', type=float, default=90)
+  optional.add_argument('--all-devices', help='with -dp, also delete the device each user was seen on last', action='store_true')
+  optional.add_argument('--deactivate-batch', metavar='file', help='with -ua, write a batch file deactivating the inactive users', type=str)
+  optional.add_argument('-h', '--help', help='show this help message and exit', action='help')
+  args = parser.parse_args(argv)
+
+  # Read config.json
+  config = core.open_config()
+  workers = config.get('concurrency', 4)
+  if args.workers != None:
+    workers = args.workers
+  index = config.get('index', 'index.db')
+
+  fields = None
+  if args.fields != None:
+    fields = args.fields.split(',')
+
+  # Queries to the local index don't need the server
+  if args.li and args.refresh == False:
+    query_index(index, args, fields)
+    exit()
+
+  if args.b != None and os.path.exists(args.b) == False:
+    print('No batch file ' + args.b + '.')
+    exit()
+
+  core.configure(config)
+  global admin
+  admin = core.override(config, args)
+
+  # Logs in to get a token, keeping stdout for user lists
+  token = core.log_in(admin, file=sys.stderr)
+  headers = {'Authorization': 'Bearer '+ token, 'Content-Type': 'application/json'}
+
+  # Resyncs the local index
+  if args.refresh:
+    refresh_index(headers, index, args.limit)
+
+  # TODO: How can we do this long conditional more efficient?
+  # Creates user
+  if args.uc:
+    user = core.fq_user(args.uc, core.server_name)
+    create_user(headers, user)
+  # Deactivates user
+  elif args.ud:
+    user = core.fq_user(args.ud, core.server_name)
+    deactivate_user(headers, user)
+  # Resets user's password
+  elif args.ur:
+    user = core.fq_user(args.ur, core.server_name)
+    reset_pass(headers, user)
+  # Reactivates user
+  elif args.ux:
+    user = core.fq_user(args.ux, core.server_name)
+    reactivate_user(headers, user)
+  # Lists all users
+  elif args.la:
+    list_a_users(headers, fields, args.format, args.limit)
+  # Lists current users
+  elif args.lc:
+    list_c_users(headers, fields, args.format, args.limit)
+  # Lists users from the local index
+  elif args.li:
+    query_index(index, args, fields)
+  # Lists a user
+  elif args.lu:
+    user = core.fq_user(args.lu, core.server_name)
+    list_user(headers, user)
+  # Makes user admin
+  elif args.am:
+    user = core.fq_user(args.am, core.server_name)
+    make_admin(headers, user)
+  # Admin query
+  elif args.aq:
+    user = core.fq_user(args.aq, core.server_name)
+    check_admin(headers, user)
+  # Invalidates all tokes of an admin
+  elif args.at:
+    log_out_a(headers)
+  # Makes an admin user regular
+  elif args.ax:
+    user = core.fq_user(args.ax, core.server_name)
+    make_regular(headers, user)
+  # Audits users
+  elif args.ua:
+    audit(headers, fields, args.format, args.limit, workers, args.inactive_days, args.stale_days, args.deactivate_batch)
+  # Deletes stale devices
+  elif args.dp:
+    prune_devices(headers, fields, args.format, args.limit, workers, args.stale_days, args.all_devices == False)
+  # Runs a batch of actions
+  elif args.b:
+    report = args.report
+    if report == None:
+      report = args.b + '.report.csv'
+    run_batch(headers, args.b, workers, report)
+  else:
+    core.log_out(headers, file=sys.stderr)
+    if args.refresh == False:
+      print('Nothing to do. Use a valid argument.')
+    exit()
+  core.log_out(headers, file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()